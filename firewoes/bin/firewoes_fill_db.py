@@ -18,85 +18,414 @@
 
 # Reads a Firehose-related XML file and injects it to a DB
 
-import os, sys
+import os, sys, time
 import argparse
+import itertools
+import collections
+import multiprocessing
+
+from sqlalchemy import select
 
 import firewoes.lib.orm as fhm
-from firewoes.lib.hash import idify, uniquify
+from firewoes.lib.hash import idify, uniquify, walk, known_key, \
+    UNIQUE_CACHE_SIZE
+from firewoes.lib.cache import LRUCache, KnownIds
 from firewoes.lib.dbutils import get_engine_session
+from firewoes.lib.bulk import bulk_insert, shared_rows, update_owned_columns
+from firewoes.lib.pgcopy import CopyLoader
+from firewoes.lib.sources import iter_sources
+from firewoes.lib.manifest import Manifest, \
+    metadata as manifest_metadata
+import firewoes.lib.search as search
+import firewoes.lib.generation as generation
 
 from xml.etree.ElementTree import ParseError as XmlParseError
 
 metadata = fhm.metadata
 
+# number of reports read in advance per parsing process
+PARSE_QUEUE_FACTOR = 8
+
 
-def insert_analysis(session, xml_file):
+def parse_analysis(xml_file):
     """
-    Given a file object and a session, creates a Firehose Analysis() object
-    and inserts it to the db linked to session
+    Given a file object (or path), creates a Firehose Analysis() object
+    and idifies it. Returns None if the file can't be read.
+    This doesn't need any db access, so it can run in a worker process.
     """
     try:
         analysis = fhm.Analysis.from_xml(xml_file)
     except XmlParseError:
-        return # if file is empty for example
+        return None # if file is empty for example
     except Exception as e:
         print("ERROR while parsing xml: %s" % e)
-        return
+        return None
     
     #idify:
     try:
         (analysis, analysishash) = idify(analysis)
     except Exception as e:
         print("ERROR while idify Analysis: %s" % e)
-        import sys; sys.exit()
+        return None
     
-    # unicity:
+    return analysis
+
+def store_analysis(session, analysis):
+    """
+    Given an idified Analysis() object and a session, adds it to the current
+    transaction of session, inside a savepoint: if something goes wrong, only
+    this analysis is rolled back and the exception is raised again.
+    The caller is responsible for committing the transaction.
+    A node listed by several parents belongs to the last one, as with the
+    other loaders (see firewoes.lib.bulk).
+    """
+    session.begin_nested()
     try:
+        shared = shared_rows(analysis)
+        # unicity:
         analysis = uniquify(session, analysis)
+        session.merge(analysis)
+        session.flush()
+        # the ORM sets the parent of a shared node in no particular order
+        for (table, rows) in shared.items():
+            update_owned_columns(session.connection(), table, rows)
+        session.commit() # releases the savepoint
+    except:
+        session.rollback() # rolls back to the savepoint
+        # the cache may reference objects we just rolled back:
+        if getattr(session, '_unique_cache', None) is not None:
+            session._unique_cache.clear()
+        raise
+
+def _index_analyses(connection, analysis_ids):
+    """
+    Adds the analyses to the search table and bumps the data generation, in
+    the transaction of connection, which also inserted them: the analyses
+    can't be committed without their search rows.
+    """
+    if analysis_ids:
+        search.add_analyses(connection, analysis_ids)
+        generation.bump_generation(connection)
+
+def _analysis_exists(connection, analysis_id):
+    return connection.execute(
+        select([fhm.t_analysis.c.id]).where(
+            fhm.t_analysis.c.id == analysis_id)).first() is not None
+
+class OrmWriter(object):
+    """
+    Inserts analyses with the ORM (uniquify + merge).
+    If the session has a store of known ids (session._known_ids), the ids of
+    the committed analyses are added to it.
+    """
+    def __init__(self, engine, session):
+        self.session = session
+        self.known = getattr(session, '_known_ids', None)
+        self.new_keys = [] # keys to add to self.known on commit
+    
+    def exists(self, analysis_id):
+        return self.session.query(fhm.Analysis.id).filter(
+            fhm.Analysis.id == analysis_id).first() is not None
+    
+    def store(self, analysis):
+        if self.known is not None:
+            # uniquify replaces the nodes, we get their keys before:
+            keys = [known_key(node) for node in walk(analysis)]
+        store_analysis(self.session, analysis)
+        if self.known is not None:
+            self.new_keys.extend(keys)
+    
+    def commit(self, analysis_ids=()):
+        _index_analyses(self.session.connection(), analysis_ids)
+        self.session.commit()
+        if self.known is not None:
+            self.known.update(self.new_keys)
+            self.new_keys = []
+    
+    def close(self):
+        if self.known is not None:
+            self.known.close()
+        self.session.remove()
+
+class CoreWriter(object):
+    """
+    Inserts analyses with SQLAlchemy Core, see firewoes.lib.bulk.
+    Each analysis is inserted inside a savepoint, like with the ORM.
+    """
+    def __init__(self, engine, session):
+        self.connection = engine.connect()
+        self.transaction = self.connection.begin()
+    
+    def exists(self, analysis_id):
+        return _analysis_exists(self.connection, analysis_id)
+    
+    def store(self, analysis):
+        savepoint = self.connection.begin_nested()
+        try:
+            bulk_insert(self.connection, analysis)
+            savepoint.commit()
+        except:
+            savepoint.rollback()
+            raise
+    
+    def commit(self, analysis_ids=()):
+        _index_analyses(self.connection, analysis_ids)
+        self.transaction.commit()
+        self.transaction = self.connection.begin()
+    
+    def close(self):
+        self.connection.close()
+
+class CopyWriter(object):
+    """
+    Loads analyses with PostgreSQL's COPY, see firewoes.lib.pgcopy.
+    The analyses are sent to the db only on commit, so a failure there
+    rolls back the whole batch: use it with a big --batch-size, to
+    (re)build a database from a whole archive.
+    """
+    def __init__(self, engine, session):
+        self.connection = engine.connect()
+        self.transaction = self.connection.begin()
+        self.loader = CopyLoader(self.connection)
+        self.buffered = set() # ids of the analyses not flushed yet
+    
+    def exists(self, analysis_id):
+        return (analysis_id in self.buffered
+                or _analysis_exists(self.connection, analysis_id))
+    
+    def store(self, analysis):
+        self.loader.add(analysis)
+        self.buffered.add(analysis.id)
+    
+    def commit(self, analysis_ids=()):
+        self.loader.flush()
+        _index_analyses(self.connection, analysis_ids)
+        self.buffered = set()
+        self.transaction.commit()
+        self.transaction = self.connection.begin()
+    
+    def close(self):
+        self.connection.close()
+
+writers = dict(orm=OrmWriter,
+               core=CoreWriter,
+               copy=CopyWriter)
+
+def _parse_worker(source):
+    """
+    Runs in a worker process: returns the idified analysis of a ReportSource.
+    Exceptions are returned rather than raised, to be reported by the writer.
+    """
+    try:
+        xml_file = source.open()
+        try:
+            return parse_analysis(xml_file)
+        finally:
+            xml_file.close()
     except Exception as e:
-        print("ERROR while uniquify Analysis: %s" % e)
-        import sys; sys.exit()
+        return e
 
-    session.merge(analysis)
-    session.commit()
+def _parsed_analyses(sources, jobs=1):
+    """
+    Yields (source, analysis) for each source, analysis being None if the
+    file can't be read, or an exception.
+    With jobs > 1, parsing and idify are done by a pool of processes, but the
+    results are yielded in the order of sources, so that the writer inserts
+    exactly what the serial path would. At most jobs * PARSE_QUEUE_FACTOR
+    sources are read in advance.
+    """
+    if jobs <= 1:
+        for source in sources:
+            yield (source, _parse_worker(source))
+        return
     
-def read_and_create(url, xml_files, drop=False, echo=False):
+    pool = multiprocessing.Pool(processes=jobs)
+    pending = collections.deque()
+    try:
+        for source in sources:
+            pending.append(
+                (source, pool.apply_async(_parse_worker, (source,))))
+            if len(pending) >= jobs * PARSE_QUEUE_FACTOR:
+                (source, res) = pending.popleft()
+                yield (source, res.get())
+        while pending:
+            (source, res) = pending.popleft()
+            yield (source, res.get())
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def read_and_create(url, xml_files, drop=False, echo=False, jobs=1,
+                    batch_size=1, loader="orm", cache_size=UNIQUE_CACHE_SIZE,
+                    known_ids=None, manifest=False, since=False,
+                    rebuild_search=False):
+    """
+    Inserts the analyses of xml_files, committing every batch_size analyses.
+    xml_files can be a generator of paths of reports, archives or
+    directories (see firewoes.lib.sources).
+    loader is the name of the writer to use (see writers).
+    cache_size is the maximum number of objects kept in memory by uniquify,
+    and known_ids the path of a file where the ids already inserted are
+    remembered from one run to another (only with the orm loader).
+    If manifest is True, the files already imported (according to the
+    ingestion manifest, see firewoes.lib.manifest) are skipped, and if since
+    is True, so are the files older than the last successful run.
+    The search table (see firewoes.lib.search) is updated at each commit, and
+    rebuilt first if rebuild_search is True.
+    """
+    if known_ids is not None and loader != "orm":
+        raise Exception("The known ids are only used by the orm loader, "
+                        "not %s" % loader)
     engine, session = get_engine_session(url, echo=echo)
     
     if drop:
+        manifest_metadata.drop_all(bind=engine)
+        search.metadata.drop_all(bind=engine)
         metadata.drop_all(bind=engine) # cleans the table (for debugging)
         metadata.create_all(bind=engine)
+    search.metadata.create_all(bind=engine)
+    # not dropped: the generation must keep increasing
+    generation.metadata.create_all(bind=engine)
+    if rebuild_search or drop:
+        with engine.begin() as connection:
+            if rebuild_search:
+                search.rebuild(connection)
+            generation.bump_generation(connection)
+    
+    session._unique_cache = LRUCache(cache_size)
+    if known_ids is not None:
+        session._known_ids = KnownIds(known_ids, clear=drop)
+    
+    writer = writers[loader](engine, session)
+    
+    sources = iter_sources(xml_files)
+    if manifest or since:
+        manifest = Manifest(engine)
+        last_run = manifest.last_successful_run() if since else None
+        sources = manifest.filter_new(sources, since=last_run)
+        manifest.start_run()
+    else:
+        manifest = None
     
-    number_of_files = len(xml_files)
-    for (counter, file_) in enumerate(xml_files):
+    committed_ids = [] # ids of the analyses of the current batch
+    
+    def commit():
+        # the search rows are written in the same transaction
+        writer.commit(committed_ids)
+        del committed_ids[:]
+        if manifest is not None:
+            # only once the analyses are in the db
+            manifest.commit()
+    
+    start_time = time.time()
+    number_of_analyses = 0
+    number_of_duplicates = 0 # analyses already in the db
+    in_transaction = 0 # number of analyses waiting for a commit
+    for (counter, (file_, analysis)) in enumerate(
+        _parsed_analyses(sources, jobs=jobs)):
         try:
-            insert_analysis(session, file_)
+            if isinstance(analysis, Exception):
+                raise analysis
+            if analysis is not None:
+                # the id is a hash of the whole analysis: if it exists,
+                # there's nothing to insert
+                if writer.exists(analysis.id):
+                    number_of_duplicates += 1
+                else:
+                    writer.store(analysis)
+                    committed_ids.append(analysis.id)
+                    number_of_analyses += 1
+                    in_transaction += 1
+            if manifest is not None:
+                # files without a valid analysis are recorded too, so that
+                # they aren't read again
+                manifest.record(file_, analysis.id
+                                if analysis is not None else None)
         except Exception as e:
             print("Error in file %s" % file_)
             print(e)
         
-        # % counter:
-        sys.stdout.write(str(int(float(counter + 1)
-                                 / float(number_of_files) * 100)))
-        sys.stdout.write(" %")
+        if in_transaction >= batch_size:
+            commit()
+            in_transaction = 0
+        
+        # counter (we don't know the total number of files):
+        sys.stdout.write("%d files" % (counter + 1))
         sys.stdout.write("\r")
         sys.stdout.flush()
     
+    commit()
+    if manifest is not None:
+        manifest.finish_run()
     sys.stdout.write("\n")
     
-    session.remove()
+    elapsed = time.time() - start_time
+    print("%d analyses inserted in %.1fs (%.1f analyses/s)"
+          % (number_of_analyses, elapsed,
+             number_of_analyses / elapsed if elapsed else 0))
+    print("%d duplicate analyses ignored" % number_of_duplicates)
+    if manifest is not None:
+        print("%d files skipped (already imported)" % manifest.skipped)
+    
+    writer.close()
 
 if __name__ == "__main__":
     
     parser = argparse.ArgumentParser(description="Reads XML from standard\
     input and adds the Firehose objects into the specified database")
     parser.add_argument("db_url", help="URL of the database")
-    parser.add_argument("xml_file", help="Path of the XML file", nargs="+")
+    parser.add_argument("xml_file", help="Path of the XML file (which can"
+                        " be compressed with gzip or xz), of a tar archive"
+                        " or of a directory containing them", nargs="*")
+    parser.add_argument("--stdin", help="also reads the paths on standard"
+                        " input, one per line", action="store_true")
     parser.add_argument("--drop", help="drops the database before filling",
                         action="store_true")
     parser.add_argument("--verbose", help="outputs SQLAlchemy requests",
                         action="store_true")
+    parser.add_argument("--jobs", help="number of processes parsing the XML"
+                        " files (default: 1)", type=int, default=1)
+    parser.add_argument("--batch-size", help="number of analyses inserted in"
+                        " a single transaction (default: 1)", type=int,
+                        default=1)
+    parser.add_argument("--loader", help="how the analyses are inserted:"
+                        " with the ORM, with bulk inserts through"
+                        " SQLAlchemy Core, or with PostgreSQL's COPY"
+                        " (default: orm)",
+                        choices=sorted(writers.keys()), default="orm")
+    parser.add_argument("--cache-size", help="maximum number of objects kept"
+                        " in memory to avoid db lookups (default: %d)"
+                        % UNIQUE_CACHE_SIZE, type=int,
+                        default=UNIQUE_CACHE_SIZE)
+    parser.add_argument("--known-ids", help="file where the ids already in"
+                        " the db are stored, to avoid looking them up on the"
+                        " next runs (emptied with --drop, orm loader only)")
+    parser.add_argument("--manifest", help="skips the files already imported"
+                        " (same size and modification time, or same content)"
+                        " and records the new ones", action="store_true")
+    parser.add_argument("--rebuild-search", help="recreates the search tables"
+                        " used by the web application from the analyses"
+                        " already in the db", action="store_true")
+    parser.add_argument("--since", help="only reads the files modified since"
+                        " the last successful run (implies --manifest)",
+                        action="store_true")
     args = parser.parse_args()
+    if args.known_ids is not None and args.loader != "orm":
+        parser.error("--known-ids is only used by the orm loader")
+    
+    paths = args.xml_file
+    if args.stdin:
+        paths = itertools.chain(paths, (line.rstrip("\n")
+                                        for line in sys.stdin
+                                        if line.strip()))
     
-    read_and_create(args.db_url, args.xml_file, drop=args.drop, echo=args.verbose)
+    read_and_create(args.db_url, paths, drop=args.drop,
+                    echo=args.verbose, jobs=args.jobs,
+                    batch_size=args.batch_size, loader=args.loader,
+                    cache_size=args.cache_size, known_ids=args.known_ids,
+                    manifest=args.manifest, since=args.since,
+                    rebuild_search=args.rebuild_search)
     
@@ -6,6 +6,7 @@ from email.utils import parseaddr
 from firewoes.lib.dbutils import get_engine_session
 from firewoes.lib.debianutils import Base, DebianPackage, DebianMaintainer, \
     DebianPackagePeopleMapping
+import firewoes.lib.generation as generation
 
 metadata = Base.metadata
 
@@ -133,3 +134,8 @@ if __name__ == "__main__":
     ftpo = ftp_connect(url)
     generate_packages_for_people(ftpo, path, session)
     ftp_close(ftpo)
+
+    # the maintainer filter of the web application depends on these tables
+    generation.metadata.create_all(engine)
+    with engine.begin() as connection:
+        generation.bump_generation(connection)
@@ -0,0 +1,263 @@
+# Copyright (C) 2013  Matthieu Caneill <matthieu.caneill@gmail.com>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Inserts idified Firehose trees with SQLAlchemy Core, bypassing the ORM
+unit of work: the tree is flattened into rows for each table, which are
+inserted with one executemany per table. Since the ids are hashes of the
+content, rows which already exist are simply ignored.
+
+A node listed by several parents (a result shared by several analyses, a
+state shared by several traces) belongs to the last one: the last analysis
+inserted, and inside an analysis the last parent in the order of the tree.
+The foreign keys to the parent (see owned_columns()) of the existing rows
+are thus updated.
+"""
+
+from sqlalchemy import text, select, bindparam
+from sqlalchemy.orm import object_mapper, class_mapper
+from sqlalchemy.orm.interfaces import MANYTOONE, ONETOMANY
+
+from firewoes.lib.orm import metadata, Analysis
+from firewoes.lib.hash import IN_CLAUSE_MAX_SIZE
+from firewoes.lib.dbutils import has_upsert
+
+_owned_columns = None
+
+def owned_columns():
+    """
+    Returns table -> names of its columns set by a one-to-many relationship
+    of the parent (e.g. state.trace_id, by Trace.states).
+    """
+    global _owned_columns
+    if _owned_columns is None:
+        _owned_columns = {}
+        # the mappers of the Firehose tree
+        stack = [class_mapper(Analysis)]
+        seen = set()
+        while stack:
+            mapper = stack.pop()
+            if mapper in seen:
+                continue
+            seen.add(mapper)
+            stack.extend(mapper.self_and_descendants)
+            for prop in mapper.relationships:
+                stack.append(prop.mapper)
+                if prop.direction is ONETOMANY:
+                    for (local, remote) in prop.synchronize_pairs:
+                        _owned_columns.setdefault(
+                            remote.table, set()).add(remote.key)
+    return _owned_columns
+
+def _column_value(obj, mapper, column):
+    """
+    Returns the value of obj for a table column. Several properties can
+    map the same column (e.g. Failure.failureid and Result.testid), we take
+    the one which is set.
+    """
+    value = None
+    for prop in mapper.column_attrs:
+        if column in prop.columns:
+            value = getattr(obj, prop.key, None)
+            if value is not None:
+                break
+    return value
+
+def _add_row(rows, table, row, from_parent=False):
+    """
+    Adds row to rows[table], or completes the row already there with the
+    same id. A row set from the parent side (the foreign keys to the parent)
+    replaces the values already there: the last parent wins.
+    """
+    table_rows = rows.setdefault(table, {})
+    existing = table_rows.get(row["id"])
+    if existing is None:
+        table_rows[row["id"]] = row
+    else:
+        for (key, value) in row.items():
+            if from_parent or existing.get(key) is None:
+                existing[key] = value
+    return table_rows[row["id"]]
+
+def _flatten(analysis):
+    """
+    Returns (rows, parents): the rows of flatten(), and
+    (table, id) -> ids of the parents listing the node.
+    """
+    rows = {}
+    parents = {}
+    stack = [analysis]
+    while stack:
+        obj = stack.pop()
+        mapper = object_mapper(obj)
+        table = mapper.local_table
+
+        row = dict((column.key, _column_value(obj, mapper, column))
+                   for column in table.columns)
+        if mapper.polymorphic_on is not None:
+            row[mapper.polymorphic_on.key] = mapper.polymorphic_identity
+
+        # foreign keys come from the relationships
+        children = []
+        for prop in mapper.relationships:
+            value = getattr(obj, prop.key, None)
+            if value is None:
+                continue
+            if prop.direction is MANYTOONE:
+                for (remote, local) in prop.synchronize_pairs:
+                    row[local.key] = _column_value(value, object_mapper(value),
+                                                   remote)
+                children.append(value)
+            elif prop.direction is ONETOMANY:
+                for child in value:
+                    child_table = object_mapper(child).local_table
+                    child_row = dict(
+                        (remote.key, _column_value(obj, mapper, local))
+                        for (local, remote) in prop.synchronize_pairs)
+                    child_row["id"] = child.id
+                    _add_row(rows, child_table, child_row, from_parent=True)
+                    parents.setdefault((child_table, child.id),
+                                       set()).add(obj.id)
+                    children.append(child)
+
+        _add_row(rows, table, row)
+        # the nodes are visited in the order of the tree, so that the last
+        # parent of a node is the last one in the tree
+        stack.extend(reversed(children))
+
+    return (dict((table, table_rows.values())
+                 for (table, table_rows) in rows.items()),
+            parents)
+
+def flatten(analysis):
+    """
+    Flattens an idified Analysis into rows.
+    Returns a dict: table -> list of rows, a row being a dict
+    column name -> value.
+    """
+    return _flatten(analysis)[0]
+
+def shared_rows(analysis):
+    """
+    Returns the rows (see flatten()) of the nodes listed by several parents
+    of an idified Analysis, table by table, with the foreign keys of their
+    last parent.
+    """
+    (rows, parents) = _flatten(analysis)
+    shared = {}
+    for (table, table_rows) in rows.items():
+        for row in table_rows:
+            if len(parents.get((table, row["id"]), ())) > 1:
+                shared.setdefault(table, []).append(row)
+    return shared
+
+def on_conflict(dialect, table):
+    """
+    Returns the ON CONFLICT clause of an insert in table, which ignores the
+    rows whose id already exists, but updates their owned columns, or None
+    if the dialect doesn't support it.
+    """
+    if not has_upsert(dialect):
+        return None
+    distinct = "IS DISTINCT FROM" if dialect.name == "postgresql" \
+        else "IS NOT"
+    owned = sorted(owned_columns().get(table, ()))
+    if not owned:
+        return "ON CONFLICT (id) DO NOTHING"
+    preparer = dialect.identifier_preparer
+    table_name = preparer.format_table(table)
+    columns = [preparer.format_column(table.c[key]) for key in owned]
+    return ("ON CONFLICT (id) DO UPDATE SET %s WHERE %s" % (
+            ", ".join("%s = excluded.%s" % (column, column)
+                      for column in columns),
+            " OR ".join("%s.%s %s excluded.%s"
+                        % (table_name, column, distinct, column)
+                        for column in columns)))
+
+def update_owned_columns(connection, table, rows):
+    """
+    Sets the owned columns of the existing rows of table to their values
+    in rows.
+    """
+    owned = sorted(owned_columns().get(table, ()))
+    if not owned or not rows:
+        return
+    connection.execute(
+        table.update().where(table.c.id == bindparam("row_id"))
+        .values(dict((key, bindparam("owned_" + key)) for key in owned)),
+        [dict([("row_id", row["id"])]
+              + [("owned_" + key, row[key]) for key in owned])
+         for row in rows])
+
+def _insert_statement(dialect, table):
+    """
+    Returns a statement inserting rows in table, ignoring the ones whose id
+    already exists (but their owned columns), or None if the dialect can't
+    do that.
+    """
+    conflict = on_conflict(dialect, table)
+    if conflict is None:
+        return None
+    preparer = dialect.identifier_preparer
+    return text("INSERT INTO %s (%s) VALUES (%s) %s" % (
+            preparer.format_table(table),
+            ", ".join(preparer.format_column(column)
+                      for column in table.columns),
+            ", ".join(":" + column.key for column in table.columns),
+            conflict))
+
+def _existing_ids(connection, table, rows):
+    """
+    Returns the ids of rows which already exist in table.
+    """
+    ids = sorted(row["id"] for row in rows)
+    existing = set()
+    for i in range(0, len(ids), IN_CLAUSE_MAX_SIZE):
+        existing.update(res[0] for res in connection.execute(
+                select([table.c.id]).where(
+                    table.c.id.in_(ids[i:i+IN_CLAUSE_MAX_SIZE]))))
+    return existing
+
+def insert_rows(connection, rows):
+    """
+    Inserts rows (as returned by flatten()), table by table, in the order
+    of their foreign keys dependencies.
+    """
+    for table in metadata.sorted_tables:
+        table_rows = rows.get(table)
+        if not table_rows:
+            continue
+        statement = _insert_statement(connection.dialect, table)
+        if statement is None:
+            # portable fallback: we check the ids first
+            existing = _existing_ids(connection, table, table_rows)
+            update_owned_columns(connection, table,
+                                 [row for row in table_rows
+                                  if row["id"] in existing])
+            table_rows = [row for row in table_rows
+                          if row["id"] not in existing]
+            if not table_rows:
+                continue
+            statement = table.insert()
+        connection.execute(statement, table_rows)
+
+def bulk_insert(connection, analysis):
+    """
+    Inserts an idified Analysis, using an SQLAlchemy connection.
+    """
+    insert_rows(connection, flatten(analysis))
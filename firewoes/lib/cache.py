@@ -0,0 +1,84 @@
+# Copyright (C) 2013  Matthieu Caneill <matthieu.caneill@gmail.com>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import anydbm
+from collections import OrderedDict
+
+class LRUCache(object):
+    """
+    A dict-like cache, which holds at most max_entries entries: when it's
+    full, the least recently used entry is evicted.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        # we move the entry to the end (most recently used)
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def __delitem__(self, key):
+        del self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def get(self, key, default=None):
+        if key in self.entries:
+            return self[key]
+        return default
+
+    def clear(self):
+        self.entries.clear()
+
+class KnownIds(object):
+    """
+    A set of strings stored on disk (in a dbm file), to remember from one run
+    to another which objects are already in the db.
+    """
+    def __init__(self, path, clear=False):
+        """
+        Opens (or creates) the store at path. If clear is True, its previous
+        content is discarded.
+        """
+        self.db = anydbm.open(path, "n" if clear else "c")
+
+    def __contains__(self, key):
+        return self.db.has_key(key)
+
+    def update(self, keys):
+        for key in keys:
+            if not self.db.has_key(key):
+                self.db[key] = ""
+
+    def close(self):
+        self.db.close()
@@ -16,11 +16,31 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from sqlalchemy import create_engine
+import sqlite3
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, scoped_session
 
+def _fix_sqlite_savepoints(engine):
+    """
+    pysqlite handles transactions by itself, which breaks SAVEPOINT (used
+    by session.begin_nested()): we let SQLAlchemy emit BEGIN instead.
+    See the "Serializable isolation / Savepoints" section of the SQLAlchemy
+    SQLite dialect documentation.
+    """
+    @event.listens_for(engine, "connect")
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+    
+    @event.listens_for(engine, "begin")
+    def do_begin(conn):
+        conn.execute("BEGIN")
+
 def _get_engine(url, echo):
-    return create_engine(url, echo=echo)
+    engine = create_engine(url, echo=echo)
+    if engine.dialect.name == "sqlite":
+        _fix_sqlite_savepoints(engine)
+    return engine
 
 def get_engine_session(url, echo=False):
     """
@@ -29,3 +49,14 @@ def get_engine_session(url, echo=False):
     engine = _get_engine(url, echo=echo)
     session = scoped_session(sessionmaker(bind=engine, autoflush=True))
     return engine, session
+
+def has_upsert(dialect):
+    """
+    Returns True if the db supports INSERT ... ON CONFLICT (PostgreSQL 9.5,
+    SQLite 3.24).
+    """
+    if dialect.name == "postgresql":
+        return (dialect.server_version_info is None
+                or dialect.server_version_info >= (9, 5))
+    return (dialect.name == "sqlite"
+            and sqlite3.sqlite_version_info >= (3, 24))
@@ -0,0 +1,67 @@
+# Copyright (C) 2013  Matthieu Caneill <matthieu.caneill@gmail.com>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+The data generation is a counter, bumped by firewoes_fill_db and
+firewoes_pack_people_mapping each time they commit new data, so that the
+web application knows when its caches are out of date.
+"""
+
+import time
+
+from sqlalchemy import Table, MetaData, Column, Integer, Float, select
+
+metadata = MetaData()
+
+t_data_generation = \
+    Table('data_generation', metadata,
+          Column('id', Integer, primary_key=True, autoincrement=False),
+          Column('generation', Integer, nullable=False),
+          Column('updated_at', Float), # timestamp of the last bump
+          )
+
+# the table has a single row
+_ROW_ID = 1
+
+def get_version(bind):
+    """
+    Returns (generation, timestamp of its commit), or (0, None) if nothing
+    was ever committed.
+    bind can be an engine, a connection or a session.
+    """
+    row = bind.execute(
+        select([t_data_generation.c.generation,
+                t_data_generation.c.updated_at]).where(
+            t_data_generation.c.id == _ROW_ID)).first()
+    if row is None:
+        return (0, None)
+    return (row.generation, row.updated_at)
+
+def bump_generation(connection):
+    """
+    Increments the generation, in the transaction of connection.
+    """
+    now = time.time()
+    result = connection.execute(
+        t_data_generation.update()
+        .where(t_data_generation.c.id == _ROW_ID)
+        .values(generation=t_data_generation.c.generation + 1,
+                updated_at=now))
+    if result.rowcount == 0:
+        connection.execute(t_data_generation.insert().values(
+                id=_ROW_ID, generation=1, updated_at=now))
@@ -18,6 +18,18 @@
 
 import hashlib
 from firehose.model import _string_type
+from sqlalchemy.orm import class_mapper
+
+from firewoes.lib.cache import LRUCache
+
+# maximum number of ids in a single IN (...) clause
+IN_CLAUSE_MAX_SIZE = 500
+
+# types of the Firehose attributes which aren't nodes
+_SCALAR_TYPES = (int, float, str, _string_type)
+
+# default maximum number of objects kept by uniquify between two analyses
+UNIQUE_CACHE_SIZE = 100000
 
 def strhash(string):
     """
@@ -26,6 +38,14 @@ def strhash(string):
     """
     return hashlib.sha1(string).hexdigest()
 
+def _scalar_hash(value):
+    """
+    Returns the hash of a scalar value (or None) in a Firehose tree
+    """
+    if value is None:
+        return strhash("")
+    return strhash(str(value))
+
 def get_attrs(obj):
     """
     For a Firehose object, returs a list of tuples (attribute_name, attribute)
@@ -33,105 +53,225 @@ def get_attrs(obj):
     """
     return [(attr.name, getattr(obj, attr.name)) for attr in obj.attrs]
 
+def _hash_items(obj):
+    """
+    Yields the (attribute_name, value) tuples which make the hash of a
+    Firehose object, in order: a list attribute gives one tuple per item.
+    """
+    for (attr_name, attr) in get_attrs(obj):
+        if isinstance(attr, list):
+            for item in attr:
+                yield (attr_name, item)
+        else:
+            yield (attr_name, attr)
+
 def idify(obj, debug=False):
     """
     Performs a bottom-up browsing of a Firehose tree, to add to each
     object its id, which is its cryptographic hash.
-    Acts recursively.
     Returns a tuple: (object_with_id, object_id(=object_hash))
     
     The hash is calculated with the concatenation of node's children, e.g.:
         hash(Generator) =
         hash("name [Generator.name.hash] version [Generator.version.hash]")
+    
+    The tree is browsed with an explicit stack (deep traces don't hit the
+    recursion limit), the tokens of a node are fed one by one to its hash
+    object, and the hashes of scalar values and of the nodes appearing
+    several times in the tree are computed only once.
     """
-    def hashtoken(attr_name, obj_tuple):
+    if isinstance(obj, list):
+        return [idify(item, debug=debug) for item in obj]
+    
+    if obj is None or type(obj) in _SCALAR_TYPES:
+        return (obj, _scalar_hash(obj))
+    
+    scalar_hashes = {} # (type, value) -> hash
+    node_hashes = {} # id(node) -> hash, for the nodes already done
+    
+    def hashtoken(attr_name, value):
         """
         Returns the string chunk used to hash a tree node, e.g.:
-        hashtoken("Generator", (Generator(foobar), "54fd24ec..."))
-             = "Generator 54fd24ec"
+        hashtoken("generator", Generator(foobar))
+             = "generator 54fd24ec... "
+        value must be a scalar, or an already idified node.
         """
-        return attr_name + " " + obj_tuple[1] + " "
+        if value is None or type(value) in _SCALAR_TYPES:
+            key = (type(value), value)
+            value_hash = scalar_hashes.get(key)
+            if value_hash is None:
+                value_hash = scalar_hashes[key] = _scalar_hash(value)
+        else:
+            value_hash = node_hashes[id(value)]
+        return attr_name + " " + value_hash + " "
     
     if debug:
         print("ENTERING " + str(obj)[:60])
     
-    if obj is None:
-        return (None, strhash(""))
-    
-    elif type(obj) in [int, float, str, _string_type]:
-        return (obj, strhash(str(obj)))
+    # each frame is (node, its attribute name in its parent, hash object,
+    # iterator on its hash items), the last frame is the current node
+    stack = [(obj, None, hashlib.sha1(), _hash_items(obj))]
+    while stack:
+        (node, node_attr_name, node_hash, items) = stack[-1]
+        for (attr_name, attr) in items:
+            if (attr is not None and type(attr) not in _SCALAR_TYPES
+                and id(attr) not in node_hashes):
+                # we need the hash of this child first
+                if debug:
+                    print("ENTERING " + str(attr)[:60])
+                stack.append((attr, attr_name, hashlib.sha1(),
+                              _hash_items(attr)))
+                break
+            node_hash.update(hashtoken(attr_name, attr))
+        else:
+            # all the children are done, final hash is the id:
+            stack.pop()
+            node.id = node_hash.hexdigest()
+            node_hashes[id(node)] = node.id
+            if stack:
+                stack[-1][2].update(hashtoken(node_attr_name, node))
     
-    elif isinstance(obj, list):
-        result = [idify(item) for item in obj]
-        return result
-    
-    else:
-        objhash = ""
-        for (attr_name, attr) in get_attrs(obj):
-            res = idify(attr)
-            if debug:
-                print("SETATTR %s // %s" % (str(obj)[:40], attr_name))
-            
-            if isinstance(res, list):
-                # we get the objects:
-                items_without_hashes = [item[0] for item in res]
-                # we add their hashes:
-                for item in res:
-                    objhash += hashtoken(attr_name, item)
-                
-                # and we update the attribute:
-                setattr(obj, attr_name, items_without_hashes)
+    return (obj, obj.id)
+
+def _mapped_class(cls):
+    """
+    Returns the class whose table stores the cls objects, e.g. Sut for
+    DebianSource (the hierarchies use single table inheritance)
+    """
+    return class_mapper(cls).base_mapper.class_
+
+def _children(obj):
+    """
+    Returns the list of Firehose objects directly referenced by obj
+    """
+    children = []
+    for (attr_name, attr) in get_attrs(obj):
+        if isinstance(attr, list):
+            children.extend(attr)
+        elif (type(attr) not in (int, float, str, _string_type)
+              and attr is not None):
+            children.append(attr)
+    return children
+
+def walk(obj):
+    """
+    Yields each node of a Firehose tree
+    """
+    stack = [obj]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(_children(node))
+
+def known_key(obj):
+    """
+    Returns the key of an idified object in a KnownIds store
+    """
+    return "%s %s" % (_mapped_class(obj.__class__).__name__, obj.id)
+
+def _fetch_existing(session, obj, cache, known=None):
+    """
+    Browses a Firehose tree, and fetches the nodes which already exist in the
+    db, with one query per table (instead of one per node).
+    The subtrees of the nodes in known (a KnownIds store) are assumed to be in
+    the db too, and are only looked up if their root is missing.
+    Returns a dict: (mapped_class, id) -> object from the db
+    """
+    existing = {}
+    seen = set()
+    frontier = [obj]
+    while frontier:
+        ids = {}
+        pruned = []
+        stack = frontier
+        frontier = []
+        while stack:
+            node = stack.pop()
+            key = (node.__class__, node.id)
+            if key in seen:
+                continue
+            seen.add(key)
+            if key in cache:
+                # we keep it here, the cache may evict it in the meantime
+                existing[(_mapped_class(node.__class__), node.id)] = \
+                    cache[key]
+                continue
+            ids.setdefault(_mapped_class(node.__class__), set()).add(node.id)
+            if known is not None and known_key(node) in known:
+                pruned.append(node)
             else:
-                # we add the hash:
-                objhash += hashtoken(attr_name, res)
-                
-                # and update the attribute:
-                setattr(obj, attr_name, res[0])
+                stack.extend(_children(node))
         
-        # final hash is the id:
-        obj.id = strhash(objhash)
+        for (cls, cls_ids) in ids.items():
+            cls_ids = sorted(cls_ids)
+            for i in range(0, len(cls_ids), IN_CLAUSE_MAX_SIZE):
+                for res in (session.query(cls).filter(
+                        cls.id.in_(cls_ids[i:i+IN_CLAUSE_MAX_SIZE]))):
+                    existing[(cls, res.id)] = res
         
-        return (obj, obj.id)
+        # the store was wrong (e.g. the db has been dropped since):
+        for node in pruned:
+            if (_mapped_class(node.__class__), node.id) not in existing:
+                frontier.extend(_children(node))
+    return existing
 
 def uniquify(session, obj, debug=False):
     """
     Renders a Firehose tree unique, regarding an SQLAlchemy session.
     Inspired by http://www.sqlalchemy.org/trac/wiki/UsageRecipes/UniqueObject
-    """
-    if debug:
-        print("UNIQUIFY: %s" % str(obj)[:60])
     
+    The ids of the tree are first looked up in the db with one query per
+    table, then the nodes which already exist are replaced by the db objects.
+    
+    The session can be given a session._unique_cache (a dict, or a bounded
+    LRUCache which is created by default), and a session._known_ids store
+    (see firewoes.lib.cache.KnownIds).
+    """
     # we kep objetcs in cache for better performances
     cache = getattr(session, '_unique_cache', None)
     if cache is None:
-        session._unique_cache = cache = {}
+        session._unique_cache = cache = LRUCache(UNIQUE_CACHE_SIZE)
+    known = getattr(session, '_known_ids', None)
+    
+    with session.no_autoflush:
+        existing = _fetch_existing(session, obj, cache, known=known)
+        return _uniquify(session, obj, cache, existing, debug=debug)
+
+def _uniquify(session, obj, cache, existing, debug=False):
+    """
+    Does the job of uniquify, existing being the result of _fetch_existing
+    """
+    if debug:
+        print("UNIQUIFY: %s" % str(obj)[:60])
     
     key = (obj.__class__, obj.id)
     if key in cache:
         return cache[key]
     else:
-        with session.no_autoflush:
-            res = (session.query(obj.__class__)
-                   .filter(obj.__class__.id == obj.id).first())
-            if not res:
-                # the object doesn't exist in the db,
-                # we check recursively its attributes and add it
-                res = obj
-                
-                # recursion
-                for (attr_name, attr) in get_attrs(res):
-                    if isinstance(attr, list):
-                        # if it's a list we do this for each item
-                        setattr(res,
-                                attr_name,
-                                [uniquify(session, item) for item in attr])
-                            
-                    elif (type(attr) not in (int, float, str, _string_type)
-                          and attr is not None):
-                        setattr(res, attr_name, uniquify(session, attr))
-                
-                # we finally add it
-                session.add(res)
+        res = existing.get((_mapped_class(obj.__class__), obj.id))
+        if res is None:
+            # the object doesn't exist in the db,
+            # we check recursively its attributes and add it
+            res = obj
+            
+            # recursion
+            for (attr_name, attr) in get_attrs(res):
+                if isinstance(attr, list):
+                    # if it's a list we do this for each item
+                    setattr(res,
+                            attr_name,
+                            [_uniquify(session, item, cache, existing)
+                             for item in attr])
+                    
+                elif (type(attr) not in (int, float, str, _string_type)
+                      and attr is not None):
+                    setattr(res, attr_name,
+                            _uniquify(session, attr, cache, existing))
+            
+            # we finally add it
+            session.add(res)
+            # (the cache can be too small to hold the whole tree)
+            existing[(_mapped_class(obj.__class__), obj.id)] = res
         # update the cache
         cache[key] = res
         
@@ -0,0 +1,183 @@
+# Copyright (C) 2013  Matthieu Caneill <matthieu.caneill@gmail.com>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+The ingestion manifest remembers which report files have been imported, so
+that the next runs of firewoes_fill_db can skip them without parsing them.
+"""
+
+import time
+
+from sqlalchemy import Table, MetaData, Column, Integer, String, Float, \
+    Boolean, Index, select, func
+
+from firewoes.lib.orm import t_analysis
+
+metadata = MetaData()
+
+t_ingestion_manifest = \
+    Table('ingestion_manifest', metadata,
+          Column('path', String, primary_key=True),
+          Column('size', Integer, nullable=False),
+          Column('mtime', Float),
+          Column('digest', String, nullable=False),
+          # None if the file doesn't contain a valid analysis:
+          Column('analysis_id', String),
+          Column('imported_at', Float, nullable=False),
+          )
+Index('ix_ingestion_manifest_digest', t_ingestion_manifest.c.digest)
+
+t_ingestion_run = \
+    Table('ingestion_run', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('started_at', Float, nullable=False),
+          Column('finished_at', Float),
+          Column('success', Boolean, nullable=False, default=False),
+          )
+
+class Manifest(object):
+    """
+    The manifest of a db. The entries are loaded in memory at creation, and
+    the new ones are written by commit().
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        metadata.create_all(bind=engine)
+
+        self.entries = dict(
+            (row.path, row) for row in engine.execute(
+                t_ingestion_manifest.select()))
+        self.pending = {}
+        self.run_id = None
+        # raw content digest -> analysis id, to recognize the reports
+        # submitted again under another name
+        self.digests = dict((row.digest, row.analysis_id)
+                            for row in self.entries.values())
+        self.skipped = 0 # number of files skipped by filter_new()
+
+    def last_successful_run(self):
+        """
+        Returns the start time of the last successful run, or None.
+        """
+        return self.engine.execute(
+            select([func.max(t_ingestion_run.c.started_at)])
+            .where(t_ingestion_run.c.success == True)).scalar()
+
+    def start_run(self):
+        self.run_id = self.engine.execute(
+            t_ingestion_run.insert().values(
+                started_at=time.time(),
+                success=False)).inserted_primary_key[0]
+
+    def finish_run(self):
+        self.engine.execute(
+            t_ingestion_run.update()
+            .where(t_ingestion_run.c.id == self.run_id)
+            .values(finished_at=time.time(), success=True))
+
+    def is_known(self, source):
+        """
+        Returns True if source has already been imported: it has the same
+        size and modification time, or the same content, as in the manifest.
+        """
+        entry = self.entries.get(source.name)
+        if entry is None:
+            return False
+        (size, mtime) = source.stat()
+        if entry.size == size and entry.mtime == mtime:
+            return True
+        if entry.size == size and entry.digest == source.digest():
+            # touched, but not modified: we update its mtime
+            self.record(source, entry.analysis_id)
+            return True
+        return False
+
+    def duplicate_of(self, source):
+        """
+        If a report with the same content as source has already been
+        imported (under any name), returns the id of its analysis (None if
+        it has no valid analysis), otherwise returns False.
+        """
+        digest = source.digest()
+        if digest not in self.digests:
+            return False
+        analysis_id = self.digests[digest]
+        if analysis_id is not None and self.engine.execute(
+            select([t_analysis.c.id]).where(
+                t_analysis.c.id == analysis_id)).first() is None:
+            return False # the analysis has been deleted since
+        return analysis_id
+
+    def filter_new(self, sources, since=None):
+        """
+        Yields the sources which haven't been imported yet, and were modified
+        after since (a timestamp), if provided. The sources which can't be
+        read are yielded too.
+        """
+        for source in sources:
+            try:
+                if since is not None:
+                    mtime = source.stat()[1]
+                    if mtime is not None and mtime <= since:
+                        continue
+                if self.is_known(source):
+                    self.skipped += 1
+                    continue
+                analysis_id = self.duplicate_of(source)
+            except (IOError, OSError) as e:
+                # e.g. a dangling symlink, or a file removed meanwhile: it
+                # will fail again when read, and be reported with the others
+                print("Error while checking file %s: %s" % (source, e))
+                yield source
+                continue
+            if analysis_id is not False:
+                # we only record it, without parsing it
+                self.record(source, analysis_id)
+                self.skipped += 1
+                continue
+            yield source
+
+    def record(self, source, analysis_id):
+        """
+        Adds the entry of a source which has been imported, it will be
+        written by the next commit().
+        """
+        (size, mtime) = source.stat()
+        self.pending[source.name] = dict(
+            path=source.name,
+            size=size,
+            mtime=mtime,
+            digest=source.digest(),
+            analysis_id=analysis_id,
+            imported_at=time.time())
+        self.digests[source.digest()] = analysis_id
+
+    def commit(self):
+        """
+        Writes the pending entries, to be called once their analyses have
+        been committed.
+        """
+        if not self.pending:
+            return
+        rows = self.pending.values()
+        with self.engine.begin() as connection:
+            for row in rows:
+                connection.execute(t_ingestion_manifest.delete().where(
+                        t_ingestion_manifest.c.path == row["path"]))
+            connection.execute(t_ingestion_manifest.insert(), rows)
+        self.pending = {}
@@ -116,6 +116,7 @@ t_result = \
           Column('customfields_id', String,
                  ForeignKey('customfields.id')),
           )
+Index('ix_result_analysis_id', t_result.c.analysis_id)
 Index('ix_result_testid', t_result.c.testid)
 Index('ix_result_message_id', t_result.c.message_id)
 Index('ix_result_location_id', t_result.c.location_id)
@@ -153,14 +154,12 @@ t_message = \
           Column('id', String, primary_key=True, autoincrement=False),
           Column('text', String),
           )
-Index('ix_message_text', t_message.c.text)
 
 t_notes = \
     Table('notes', metadata,
           Column('id', String, primary_key=True, autoincrement=False),
           Column('text', String),
           )
-Index('ix_notes_text', t_notes.c.text)
 
 t_trace = \
     Table('trace', metadata,
@@ -0,0 +1,134 @@
+# Copyright (C) 2013  Matthieu Caneill <matthieu.caneill@gmail.com>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+PostgreSQL-only loader, for imports of whole archives: the rows of the
+idified analyses (see firewoes.lib.bulk.flatten) are streamed with
+COPY FROM STDIN into temporary staging tables, which are then merged into
+the real tables with one INSERT ... SELECT per table.
+As with the other loaders, a node listed by several parents belongs to the
+last one (see firewoes.lib.bulk).
+"""
+
+from tempfile import SpooledTemporaryFile
+
+from firewoes.lib.orm import metadata
+from firewoes.lib.bulk import flatten, on_conflict
+
+# above this size (in bytes), the data of a staging table is kept on disk
+STAGING_MEMORY_SIZE = 16 * 1024 * 1024
+
+def copy_value(value):
+    """
+    Returns the representation of a value in the COPY text format.
+    """
+    if value is None:
+        return "\\N"
+    elif isinstance(value, float):
+        value = repr(value)
+    elif isinstance(value, unicode):
+        value = value.encode("utf-8")
+    else:
+        value = str(value)
+    return (value
+            .replace("\\", "\\\\")
+            .replace("\t", "\\t")
+            .replace("\n", "\\n")
+            .replace("\r", "\\r"))
+
+def _staging_name(table):
+    return "staging_" + table.name
+
+class CopyLoader(object):
+    """
+    Loads analyses through staging tables. add() only buffers the rows,
+    everything is sent to the db by flush(), which must be called before
+    committing the transaction of connection.
+    """
+    def __init__(self, connection):
+        if connection.dialect.name != "postgresql":
+            raise Exception("The COPY loader needs PostgreSQL, not %s"
+                            % connection.dialect.name)
+        self.connection = connection
+        self.preparer = connection.dialect.identifier_preparer
+        self.buffers = {}
+
+        for table in metadata.sorted_tables:
+            # no constraint on the staging tables, they're dropped at the end
+            # of the session and emptied at each commit; staging_seq numbers
+            # the rows in the order they were copied
+            connection.execute(
+                "CREATE TEMPORARY TABLE IF NOT EXISTS %s (LIKE %s, "
+                "staging_seq bigserial) ON COMMIT DELETE ROWS"
+                % (_staging_name(table), self.preparer.format_table(table)))
+
+    def _columns(self, table):
+        return ", ".join(self.preparer.format_column(column)
+                         for column in table.columns)
+
+    def add(self, analysis):
+        """
+        Buffers the rows of an idified Analysis.
+        """
+        for (table, rows) in flatten(analysis).items():
+            buf = self.buffers.get(table)
+            if buf is None:
+                buf = self.buffers[table] = SpooledTemporaryFile(
+                    max_size=STAGING_MEMORY_SIZE)
+            for row in rows:
+                buf.write("\t".join(copy_value(row[column.key])
+                                    for column in table.columns))
+                buf.write("\n")
+
+    def flush(self):
+        """
+        Copies the buffered rows into the staging tables, and merges them
+        into the real tables, in the order of their foreign keys.
+        """
+        cursor = self.connection.connection.cursor()
+        try:
+            for table in metadata.sorted_tables:
+                buf = self.buffers.get(table)
+                if buf is None:
+                    continue
+                buf.seek(0)
+                cursor.copy_expert("COPY %s (%s) FROM STDIN"
+                                   % (_staging_name(table),
+                                      self._columns(table)),
+                                   buf)
+                buf.close()
+
+            for table in metadata.sorted_tables:
+                if table not in self.buffers:
+                    continue
+                # set-based dedup: inside the staging table with DISTINCT ON
+                # (the last row copied wins), and against the existing rows
+                # with ON CONFLICT
+                cursor.execute(
+                    "INSERT INTO %(table)s (%(columns)s) "
+                    "SELECT DISTINCT ON (id) %(columns)s FROM %(staging)s "
+                    "ORDER BY id, staging_seq DESC %(conflict)s"
+                    % dict(table=self.preparer.format_table(table),
+                           columns=self._columns(table),
+                           staging=_staging_name(table),
+                           conflict=on_conflict(self.connection.dialect,
+                                                table)))
+                cursor.execute("TRUNCATE %s" % _staging_name(table))
+        finally:
+            cursor.close()
+            self.buffers = {}
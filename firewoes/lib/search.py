@@ -0,0 +1,362 @@
+# Copyright (C) 2013  Matthieu Caneill <matthieu.caneill@gmail.com>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+The search table: one row per result, with the attributes of its location,
+message, sut and generator, so that the searches of the web application
+don't need to join the Firehose tables.
+It's filled at ingestion time, by firewoes_fill_db, and can be rebuilt from
+the Firehose tables with rebuild(). A result shared by several analyses
+belongs to the last one (see firewoes.lib.bulk): its row is then moved to
+the new analysis.
+
+The texts of the messages and notes are indexed for full-text searches
+(see text_match()): with a GIN index of their tsvector on PostgreSQL, and
+in an FTS5 table, filled by a trigger, on SQLite.
+
+The facet cube counts the rows of the search table for each combination of
+the most used filters (CUBE_DIMENSIONS), one row per combination, a
+missing value being stored as '' (so that the combinations can be unique).
+It's updated along with the search table, by adding the counts of the new
+rows with an upsert.
+"""
+
+import re
+
+from sqlalchemy import Table, MetaData, Column, Integer, String, Boolean, \
+    Index, DDL, event, select, exists, and_, or_, func, text, bindparam, \
+    literal_column
+from sqlalchemy.sql.expression import ColumnElement, ClauseElement, \
+    Executable
+from sqlalchemy.ext.compiler import compiles
+
+from firewoes.lib.orm import t_result, t_location, t_file, t_function, \
+    t_point, t_range, t_analysis, t_metadata, t_generator, t_sut, t_message, \
+    t_notes
+from firewoes.lib.hash import IN_CLAUSE_MAX_SIZE
+from firewoes.lib.dbutils import has_upsert
+
+metadata = MetaData()
+
+t_result_search = \
+    Table('result_search', metadata,
+          Column('result_id', String, primary_key=True, autoincrement=False),
+          Column('result_type', String(10), nullable=False),
+          Column('analysis_id', String, nullable=False),
+          Column('testid', String),
+          Column('message_id', String),
+          Column('message_text', String),
+          Column('notes_text', String),
+          Column('location_file', String),
+          Column('location_function', String),
+          Column('point_id', String),
+          Column('range_id', String),
+          Column('line', Integer), # of the point, or the start of the range
+          Column('sut_type', String(20)),
+          Column('sut_name', String),
+          Column('sut_version', String),
+          Column('sut_release', String),
+          Column('sut_buildarch', String),
+          Column('generator_name', String),
+          Column('generator_version', String),
+          )
+Index('ix_result_search_analysis_id', t_result_search.c.analysis_id)
+Index('ix_result_search_sut_name_location_file',
+      t_result_search.c.sut_name,
+      t_result_search.c.location_file,
+      t_result_search.c.location_function)
+Index('ix_result_search_generator_name_version',
+      t_result_search.c.generator_name,
+      t_result_search.c.generator_version)
+Index('ix_result_search_result_type', t_result_search.c.result_type)
+Index('ix_result_search_testid', t_result_search.c.testid)
+
+# full-text index, PostgreSQL
+_TSVECTOR = ("to_tsvector('english', coalesce(message_text, '') || ' ' || "
+             "coalesce(notes_text, ''))")
+event.listen(t_result_search, "after_create", DDL(
+        "CREATE INDEX ix_result_search_text ON result_search "
+        "USING gin (%s)" % _TSVECTOR).execute_if(dialect="postgresql"))
+
+# full-text index, SQLite: the rows deleted from the search table are only
+# deleted from the FTS table by rebuild(), which recreates it
+for statement in [
+    "CREATE VIRTUAL TABLE result_search_fts USING fts5("
+    "result_id UNINDEXED, message_text, notes_text, "
+    "tokenize='porter unicode61')",
+    "CREATE TRIGGER result_search_fts_insert AFTER INSERT ON result_search "
+    "BEGIN INSERT INTO result_search_fts (result_id, message_text, notes_text) "
+    "VALUES (new.result_id, new.message_text, new.notes_text); END"]:
+    event.listen(t_result_search, "after_create",
+                 DDL(statement).execute_if(dialect="sqlite"))
+event.listen(t_result_search, "before_drop",
+             DDL("DROP TABLE IF EXISTS result_search_fts")
+             .execute_if(dialect="sqlite"))
+
+class text_match(ColumnElement):
+    """
+    The clause of the rows of the search table whose message or notes
+    contain all the given words (with stemming, if the db supports it).
+    """
+    type = Boolean()
+
+    def __init__(self, words):
+        self.words = words
+
+def text_words(string):
+    """
+    Returns the words of a full-text search.
+    """
+    return re.findall(r"\w+", string, re.UNICODE)
+
+@compiles(text_match)
+def _text_match_default(element, compiler, **kw):
+    return compiler.process(and_(*[
+                or_(t_result_search.c.message_text.contains(word),
+                    t_result_search.c.notes_text.contains(word))
+                for word in element.words]))
+
+@compiles(text_match, "postgresql")
+def _text_match_postgresql(element, compiler, **kw):
+    return compiler.process(text(
+            "%s @@ plainto_tsquery('english', :text_match)" % _TSVECTOR,
+            bindparams=[bindparam("text_match", " ".join(element.words))]))
+
+@compiles(text_match, "sqlite")
+def _text_match_sqlite(element, compiler, **kw):
+    # each word is a quoted string, so that FTS5 doesn't interpret it
+    query = " ".join('"%s"' % word for word in element.words)
+    return compiler.process(text(
+            "result_search.result_id IN (SELECT result_id FROM "
+            "result_search_fts WHERE result_search_fts MATCH :text_match)",
+            bindparams=[bindparam("text_match", query)]))
+
+CUBE_DIMENSIONS = ["generator_name", "generator_version", "sut_type",
+                   "sut_name", "result_type", "testid"]
+
+# the value of the cube dimensions for the results without it
+CUBE_MISSING = ""
+
+t_facet_cube = \
+    Table('facet_cube', metadata,
+          *([Column(name, t_result_search.c[name].type, nullable=False)
+             for name in CUBE_DIMENSIONS]
+            + [Column('count', Integer, nullable=False)])
+          )
+# also used by the searches on generator_name (and generator_version)
+Index('ix_facet_cube_dimensions',
+      *[t_facet_cube.c[name] for name in CUBE_DIMENSIONS], unique=True)
+Index('ix_facet_cube_sut_name', t_facet_cube.c.sut_name)
+
+def cube_value(column):
+    """
+    Returns the value of a column of the facet cube, None if missing.
+    """
+    return func.nullif(column, literal_column("'%s'" % CUBE_MISSING))
+
+def _rows_select(whereclause=None):
+    """
+    Returns the SELECT of the rows of the search table, computed from the
+    Firehose tables, for the results matching whereclause.
+    The columns are in the order of t_result_search.
+    """
+    start = t_point.alias("start_point")
+    query = select(
+        [t_result.c.id,
+         t_result.c.type,
+         t_result.c.analysis_id,
+         t_result.c.testid,
+         t_result.c.message_id,
+         t_message.c.text,
+         t_notes.c.text,
+         t_file.c.givenpath,
+         t_function.c.name,
+         t_location.c.point_id,
+         t_location.c.range_id,
+         func.coalesce(t_point.c.line, start.c.line),
+         t_sut.c.type,
+         t_sut.c.name,
+         t_sut.c.version,
+         t_sut.c.release,
+         t_sut.c.buildarch,
+         t_generator.c.name,
+         t_generator.c.version],
+        from_obj=[t_result
+                  .join(t_analysis,
+                        t_result.c.analysis_id == t_analysis.c.id)
+                  .join(t_metadata,
+                        t_analysis.c.metadata_id == t_metadata.c.id)
+                  .outerjoin(t_generator,
+                             t_metadata.c.generator_id == t_generator.c.id)
+                  .outerjoin(t_sut, t_metadata.c.sut_id == t_sut.c.id)
+                  .outerjoin(t_message,
+                             t_result.c.message_id == t_message.c.id)
+                  .outerjoin(t_notes, t_result.c.notes_id == t_notes.c.id)
+                  .outerjoin(t_location,
+                             t_result.c.location_id == t_location.c.id)
+                  .outerjoin(t_file, t_location.c.file_id == t_file.c.id)
+                  .outerjoin(t_function,
+                             t_location.c.function_id == t_function.c.id)
+                  .outerjoin(t_point, t_location.c.point_id == t_point.c.id)
+                  .outerjoin(t_range, t_location.c.range_id == t_range.c.id)
+                  .outerjoin(start, t_range.c.start_id == start.c.id)])
+    if whereclause is not None:
+        query = query.where(whereclause)
+    return query
+
+def _analysis_values(connection, analysis_id):
+    """
+    Returns the values of the columns of the search table which come from
+    the analysis of a result.
+    """
+    row = connection.execute(select(
+            [t_analysis.c.id.label("analysis_id"),
+             t_sut.c.type.label("sut_type"),
+             t_sut.c.name.label("sut_name"),
+             t_sut.c.version.label("sut_version"),
+             t_sut.c.release.label("sut_release"),
+             t_sut.c.buildarch.label("sut_buildarch"),
+             t_generator.c.name.label("generator_name"),
+             t_generator.c.version.label("generator_version")],
+            from_obj=[t_analysis
+                      .join(t_metadata,
+                            t_analysis.c.metadata_id == t_metadata.c.id)
+                      .outerjoin(t_generator,
+                                 t_metadata.c.generator_id == t_generator.c.id)
+                      .outerjoin(t_sut, t_metadata.c.sut_id == t_sut.c.id)])
+        .where(t_analysis.c.id == analysis_id)).first()
+    return dict(row.items())
+
+def _move(connection, analysis_ids):
+    """
+    Moves the rows of the results which now belong to the given analyses,
+    and their counts in the facet cube. The other columns don't change:
+    they come from the result, whose id is the hash of its content.
+    """
+    moved = and_(t_result_search.c.result_id.in_(
+            select([t_result.c.id]).where(
+                t_result.c.analysis_id.in_(analysis_ids))),
+                 ~t_result_search.c.analysis_id.in_(analysis_ids))
+    if connection.execute(select([t_result_search.c.result_id])
+                          .where(moved).limit(1)).first() is None:
+        return
+    _add_counts(connection, moved, sign=-1)
+    for analysis_id in analysis_ids:
+        connection.execute(
+            t_result_search.update()
+            .where(t_result_search.c.result_id.in_(
+                    select([t_result.c.id]).where(
+                        t_result.c.analysis_id == analysis_id)))
+            .where(t_result_search.c.analysis_id != analysis_id)
+            .values(_analysis_values(connection, analysis_id)))
+    # the combinations left without results
+    connection.execute(t_facet_cube.delete().where(
+            t_facet_cube.c["count"] == 0))
+
+def _insert(connection, whereclause):
+    # the results already there (shared by several analyses) are skipped,
+    # see _move()
+    new = ~exists().where(t_result_search.c.result_id == t_result.c.id)
+    if whereclause is not None:
+        new = and_(whereclause, new)
+    connection.execute(t_result_search.insert().from_select(
+            [column.name for column in t_result_search.columns],
+            _rows_select(new)))
+
+def _counts_select(whereclause, sign=1):
+    count = func.count() if sign > 0 else -func.count()
+    dimensions = [func.coalesce(t_result_search.c[name],
+                                literal_column("'%s'" % CUBE_MISSING))
+                  for name in CUBE_DIMENSIONS]
+    counts = select([dimension.label(name) for (dimension, name)
+                     in zip(dimensions, CUBE_DIMENSIONS)]
+                    + [count.label("count")]
+                    ).group_by(*dimensions)
+    if whereclause is not None:
+        counts = counts.where(whereclause)
+    return counts
+
+def _insert_counts(connection, whereclause):
+    connection.execute(t_facet_cube.insert().from_select(
+            CUBE_DIMENSIONS + ["count"], _counts_select(whereclause)))
+
+class _upsert_counts(Executable, ClauseElement):
+    """
+    INSERT INTO facet_cube ... SELECT ... ON CONFLICT: the counts of select
+    are added to the ones of their combinations.
+    """
+    def __init__(self, select):
+        self.select = select
+
+@compiles(_upsert_counts)
+def _compile_upsert_counts(element, compiler, **kw):
+    preparer = compiler.preparer
+    table = preparer.format_table(t_facet_cube)
+    dimensions = ", ".join(preparer.format_column(t_facet_cube.c[name])
+                           for name in CUBE_DIMENSIONS)
+    count = preparer.format_column(t_facet_cube.c["count"])
+    return ("INSERT INTO %s (%s, %s) %s "
+            "ON CONFLICT (%s) DO UPDATE SET %s = %s.%s + excluded.%s" % (
+            table, dimensions, count, compiler.process(element.select),
+            dimensions, count, table, count, count))
+
+def _add_counts(connection, whereclause, sign=1):
+    """
+    Adds the counts of the rows matching whereclause (never None) to the
+    facet cube, or subtracts them if sign is -1: the combinations already
+    there are updated, the others inserted.
+    """
+    counts = _counts_select(whereclause, sign)
+    if has_upsert(connection.dialect):
+        # (SQLite needs the WHERE clause, to parse ON CONFLICT)
+        connection.execute(_upsert_counts(counts))
+        return
+    new = counts.alias("new_counts")
+    same = and_(*[t_facet_cube.c[name] == new.c[name]
+                  for name in CUBE_DIMENSIONS])
+    connection.execute(
+        t_facet_cube.update()
+        .where(exists().where(same))
+        .values(count=t_facet_cube.c["count"]
+                + select([new.c["count"]]).where(same).as_scalar()))
+    connection.execute(t_facet_cube.insert().from_select(
+            CUBE_DIMENSIONS + ["count"],
+            select([new]).where(~exists().where(same))))
+
+def add_analyses(connection, analysis_ids):
+    """
+    Adds the rows of the results of the given analyses, which must already
+    be in the Firehose tables, and their counts to the facet cube.
+    """
+    analysis_ids = list(analysis_ids)
+    for i in range(0, len(analysis_ids), IN_CLAUSE_MAX_SIZE):
+        chunk = analysis_ids[i:i+IN_CLAUSE_MAX_SIZE]
+        _move(connection, chunk)
+        _insert(connection, t_result.c.analysis_id.in_(chunk))
+        _add_counts(connection, t_result_search.c.analysis_id.in_(chunk))
+
+def rebuild(connection):
+    """
+    Drops and recreates the search table, its full-text index and the facet
+    cube (so that their schema and indexes are the current ones), and fills
+    them again from the Firehose tables.
+    """
+    metadata.drop_all(bind=connection)
+    metadata.create_all(bind=connection)
+    _insert(connection, None)
+    _insert_counts(connection, None)
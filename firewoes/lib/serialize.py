@@ -0,0 +1,95 @@
+# Copyright (C) 2013  Matthieu Caneill <matthieu.caneill@gmail.com>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Serializes the mapped objects (see firewoes.lib.orm) into dicts.
+The serializer of a class is built once, from its mapper: it knows which
+attributes are columns and which are relationships, and doesn't need to
+inspect each object.
+"""
+
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm.properties import ColumnProperty, RelationshipProperty
+
+# class -> serializer function
+_serializers = dict()
+
+def _compile(cls):
+    """
+    Returns the serializer of the objects of cls.
+    """
+    mapper = class_mapper(cls)
+    columns = []
+    relationships = [] # (name, True if it's a list)
+    for prop in mapper.iterate_properties:
+        if isinstance(prop, RelationshipProperty):
+            relationships.append((prop.key, prop.uselist))
+        elif isinstance(prop, ColumnProperty):
+            columns.append(prop.key)
+
+    def serializer(elem, path, done):
+        key = id(elem)
+        if key in done:
+            return done[key]
+        # the loaded attributes are read directly, the others are loaded
+        loaded = elem.__dict__
+        try:
+            res = {name: loaded[name] for name in columns}
+        except KeyError:
+            res = {name: getattr(elem, name) for name in columns}
+        if not relationships:
+            done[key] = res
+            return res
+        if key in path:
+            # a cycle: the relationships are being serialized
+            return res
+        path.add(key)
+        for (name, uselist) in relationships:
+            value = loaded[name] if name in loaded else getattr(elem, name)
+            if value is None:
+                res[name] = None
+            elif uselist:
+                res[name] = [(_serializers.get(type(e)) or _get(type(e)))(
+                        e, path, done) for e in value]
+            else:
+                res[name] = (_serializers.get(type(value))
+                             or _get(type(value)))(value, path, done)
+        path.remove(key)
+        done[key] = res
+        return res
+    return serializer
+
+def _get(cls):
+    serializer = _serializers[cls] = _compile(cls)
+    return serializer
+
+def serialize(elem):
+    """
+    Returns a dict of the columns and relationships of a mapped object,
+    the related objects being serialized too. An object which contains
+    itself (through its relationships) is serialized without its
+    relationships the second time.
+    An object related to several others (e.g. the file of all the states
+    of a trace) is serialized once: its dict is shared.
+    """
+    if elem is None:
+        return None
+    serializer = _serializers.get(type(elem)) or _get(type(elem))
+    # path: the ids of the objects being serialized, done: id -> dict of
+    # the objects already serialized
+    return serializer(elem, set(), dict())
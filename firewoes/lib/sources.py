@@ -0,0 +1,164 @@
+# Copyright (C) 2013  Matthieu Caneill <matthieu.caneill@gmail.com>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Finds the Firehose reports to read in files, directories and archives.
+Everything is done lazily with generators, so that the memory used doesn't
+depend on the number of reports.
+"""
+
+import os
+import gzip
+import hashlib
+import tarfile
+from io import BytesIO
+
+from firewoes.lib.hash import strhash
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None # no support for .xz files
+
+REPORT_SUFFIXES = (".xml", ".xml.gz", ".xml.xz")
+ARCHIVE_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2",
+                    ".tar.xz", ".txz")
+
+def _open_xz(fileobj_or_path):
+    if lzma is None:
+        raise Exception("xz support needs the lzma module "
+                        "(backports.lzma with Python 2)")
+    return lzma.LZMAFile(fileobj_or_path)
+
+def _decompress(name, fileobj):
+    """
+    Returns a file object reading the decompressed content of fileobj,
+    according to the extension of name.
+    """
+    if name.endswith(".gz"):
+        return gzip.GzipFile(fileobj=fileobj)
+    elif name.endswith(".xz"):
+        return _open_xz(fileobj)
+    return fileobj
+
+class ReportSource(object):
+    """
+    A report to read: a file on disk if data is None, otherwise the
+    (possibly compressed) content of an archive member, name being
+    archive_path:member_name, and mtime its modification time.
+    """
+    def __init__(self, name, data=None, mtime=None):
+        self.name = name
+        self.data = data
+        self.mtime = mtime
+        self._digest = None
+
+    def stat(self):
+        """
+        Returns (size, modification time) of the raw report.
+        """
+        if self.data is not None:
+            return (len(self.data), self.mtime)
+        stat = os.stat(self.name)
+        return (stat.st_size, stat.st_mtime)
+
+    def digest(self):
+        """
+        Returns the hash of the raw (maybe compressed) content of the report.
+        """
+        if self._digest is None:
+            if self.data is not None:
+                self._digest = strhash(self.data)
+            else:
+                sha1 = hashlib.sha1()
+                with open(self.name, "rb") as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        sha1.update(chunk)
+                self._digest = sha1.hexdigest()
+        return self._digest
+
+    def open(self):
+        """
+        Returns a file object with the XML content of the report.
+        """
+        if self.data is not None:
+            return _decompress(self.name, BytesIO(self.data))
+        return _decompress(self.name, open(self.name, "rb"))
+
+    def __str__(self):
+        return self.name
+
+def is_archive(path):
+    return path.endswith(ARCHIVE_SUFFIXES)
+
+def iter_archive(path):
+    """
+    Yields the reports of a tar archive, reading it as a stream. An archive
+    which can't be read is reported, and its remaining reports skipped.
+    """
+    tar = None
+    try:
+        if path.endswith((".xz", ".txz")):
+            tar = tarfile.open(fileobj=_open_xz(path), mode="r|")
+        else:
+            tar = tarfile.open(path, mode="r|*")
+        for member in tar:
+            if member.isfile() and member.name.endswith(REPORT_SUFFIXES):
+                yield ReportSource("%s:%s" % (path, member.name),
+                                   tar.extractfile(member).read(),
+                                   mtime=member.mtime)
+    except Exception as e:
+        # e.g. a missing file, a corrupted archive, or no lzma module
+        print("ERROR while reading archive %s: %s" % (path, e))
+    finally:
+        if tar is not None:
+            tar.close()
+
+def iter_directory(path):
+    """
+    Yields the reports found in a directory and its subdirectories,
+    archives included, in a stable order.
+    """
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            filepath = os.path.join(dirpath, filename)
+            if is_archive(filepath):
+                for source in iter_archive(filepath):
+                    yield source
+            elif filename.endswith(REPORT_SUFFIXES):
+                yield ReportSource(filepath)
+
+def iter_sources(paths):
+    """
+    Yields the reports to read for each path of paths (which can be a
+    generator), a path being a report (maybe compressed), an archive or a
+    directory.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            sources = iter_directory(path)
+        elif is_archive(path):
+            sources = iter_archive(path)
+        else:
+            sources = [ReportSource(path)]
+        for source in sources:
+            yield source
@@ -20,6 +20,7 @@ import os, sys
 
 from flask import Flask, render_template
 from firewoes.lib.dbutils import get_engine_session
+from firewoes.web.app.cache import make_cache, SharedContext
 import logging
 from logging import Formatter, StreamHandler
 
@@ -41,6 +42,10 @@ if "FIREWOES_CONFIG" in os.environ:
 engine, session = get_engine_session(app.config['DATABASE_URI'],
                                      echo=app.config['SQLALCHEMY_ECHO'])
 
+# views cache
+cache = make_cache(app.config)
+shared_context = SharedContext(session, app.config["SHARED_CONTEXT_TIMEOUT"])
+
 from frontend.views import mod as frontend_module
 app.register_blueprint(frontend_module)
 
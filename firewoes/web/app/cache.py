@@ -0,0 +1,170 @@
+# Copyright (C) 2013  Matthieu Caneill <matthieu.caneill@gmail.com>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+The cache of the views' results. The backend is chosen with CACHE_TYPE in
+the configuration; the cached entries are keyed by the data generation (see
+firewoes.lib.generation), so that they're outdated as soon as new data is
+committed.
+The template variables shared by all the pages are memoized in each process,
+by SharedContext.
+"""
+
+import time
+
+from flask import g
+
+from werkzeug.contrib import cache as backends
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from firewoes.lib.cache import LRUCache
+from firewoes.lib.generation import get_version
+
+class LRUCacheBackend(backends.BaseCache):
+    """
+    In-process cache, keeping at most threshold entries.
+    """
+    def __init__(self, threshold=500, default_timeout=300):
+        backends.BaseCache.__init__(self, default_timeout)
+        self.entries = LRUCache(threshold)
+    
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        (expires, value) = entry
+        if expires is not None and expires < time.time():
+            del self.entries[key]
+            return None
+        return value
+    
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = time.time() + timeout if timeout else None
+        self.entries[key] = (expires, value)
+        return True
+    
+    def add(self, key, value, timeout=None):
+        if self.get(key) is not None:
+            return False
+        return self.set(key, value, timeout)
+    
+    def delete(self, key):
+        if key in self.entries:
+            del self.entries[key]
+            return True
+        return False
+    
+    def has(self, key):
+        return self.get(key) is not None
+    
+    def clear(self):
+        self.entries.clear()
+        return True
+
+def make_cache(config):
+    """
+    Returns the cache backend described by config (see webconfig_default).
+    """
+    cache_type = config["CACHE_TYPE"]
+    timeout = config["CACHE_DEFAULT_TIMEOUT"]
+    if cache_type == "lru":
+        return LRUCacheBackend(threshold=config["CACHE_THRESHOLD"],
+                               default_timeout=timeout)
+    elif cache_type == "filesystem":
+        return backends.FileSystemCache(config["CACHE_DIR"],
+                                        threshold=config["CACHE_THRESHOLD"],
+                                        default_timeout=timeout)
+    elif cache_type == "memcached":
+        return backends.MemcachedCache(config["CACHE_MEMCACHED_SERVERS"],
+                                       default_timeout=timeout,
+                                       key_prefix="firewoes_")
+    elif cache_type == "redis":
+        return backends.RedisCache(config["CACHE_REDIS_HOST"],
+                                   config["CACHE_REDIS_PORT"],
+                                   default_timeout=timeout,
+                                   key_prefix="firewoes_")
+    elif cache_type == "null":
+        return backends.NullCache()
+    raise Exception("Unknown CACHE_TYPE: %s" % cache_type)
+
+def current_version(session):
+    """
+    Returns (data generation, timestamp of its commit), or None if it can't
+    be read (e.g. a db which was filled before it existed): nothing is
+    cached then.
+    """
+    try:
+        return get_version(session)
+    except SQLAlchemyError:
+        session.rollback()
+        return None
+
+def request_version(session):
+    """
+    current_version(), read once per request.
+    """
+    if not hasattr(g, "data_version"):
+        g.data_version = current_version(session)
+    return g.data_version
+
+class SharedContext(object):
+    """
+    The template variables shared by all the pages (e.g. the navigation
+    menu), computed by the functions registered with register(). Each value
+    is kept at most timeout seconds, and until the data generation changes.
+    """
+    def __init__(self, session, timeout):
+        self.session = session
+        self.timeout = timeout
+        self.functions = {}
+        self.values = {} # name -> (generation, expires, value)
+    
+    def register(self, name):
+        """
+        Decorator: the function will give the value of the variable name.
+        """
+        def decorator(func):
+            self.functions[name] = func
+            return func
+        return decorator
+    
+    def get(self):
+        """
+        Returns the dict of the variables.
+        """
+        version = request_version(self.session)
+        generation = version[0] if version is not None else None
+        now = time.time()
+        context = dict()
+        for (name, func) in self.functions.items():
+            entry = self.values.get(name)
+            if entry is None or entry[0] != generation or entry[1] < now:
+                try:
+                    entry = (generation, now + self.timeout, func())
+                except SQLAlchemyError:
+                    # we don't want to break the error pages: the outdated
+                    # value (if any) will do
+                    self.session.rollback()
+                    if entry is None:
+                        continue
+                self.values[name] = entry
+            context[name] = entry[2]
+        return context
@@ -0,0 +1,164 @@
+# Copyright (C) 2013  Matthieu Caneill <matthieu.caneill@gmail.com>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Counts the results of the search table for several facets (columns) at once,
+in a single pass over the results matching the current filters.
+The same can be done on the facet cube, whose rows are weighted by their
+count column (and whose missing values are '').
+"""
+
+from collections import Counter
+
+from sqlalchemy import select, func, and_, or_, not_, text, desc
+
+from firewoes.lib.search import t_result_search, t_facet_cube, cube_value
+
+# number of rows fetched at once by the generic scan
+FACETS_SCAN_BATCH_SIZE = 10000
+
+def _top(counts, max_items, total=None):
+    """
+    Returns (items, is_sliced, total), items being the max_items
+    (value, count) with the biggest counts.
+    """
+    items = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    if max_items is not None and len(items) > max_items:
+        return (items[:max_items], True, total)
+    return (items, False, total)
+
+def _scan(session, columns, weight, facets, clauses, max_items,
+          with_totals):
+    """
+    Any database: one scan of the matching rows, counted in Python.
+    """
+    names = facets.keys()
+    counters = dict((name, Counter()) for name in names)
+    columns = [columns[name] for name in names]
+    if weight is not None:
+        columns.append(weight)
+    query = (session.query(*columns)
+             .filter(and_(*clauses))
+             .yield_per(FACETS_SCAN_BATCH_SIZE))
+    for row in query:
+        count = row[-1] if weight is not None else 1
+        for (name, value) in zip(names, row):
+            if value is not None or facets[name][1]:
+                counters[name][value] += count
+    return dict((name, _top(counters[name], max_items,
+                            len(counters[name]) if with_totals else None))
+                for name in names)
+
+def _grouping_sets(session, columns, weight, facets, clauses, max_items,
+                   with_totals):
+    """
+    PostgreSQL: one GROUP BY GROUPING SETS, one set per facet, of which only
+    the first max_items + 1 groups of each set are returned. The totals are
+    counted by a window function over each set.
+    """
+    names = facets.keys()
+    columns = [columns[name] for name in names]
+    dialect = session.bind.dialect
+
+    # the grouping mask of a row tells which set (facet) it belongs to:
+    # all its bits are set except the one of the facet column
+    full_mask = (1 << len(names)) - 1
+    masks = [full_mask ^ (1 << (len(names) - 1 - i))
+             for i in range(len(names))]
+    grouping = func.grouping(*columns)
+
+    skipped_nulls = [and_(grouping == masks[i], columns[i] == None)
+                     for (i, name) in enumerate(names)
+                     if not facets[name][1]]
+    labels = ["facet_%d" % i for i in range(len(names))]
+    groups = (select([column.label(label)
+                      for (column, label) in zip(columns, labels)]
+                     + [grouping.label("grouping_mask"),
+                        (func.count() if weight is None
+                         else func.sum(weight)).label("count")])
+              .where(and_(*clauses))
+              .group_by(text("GROUPING SETS (%s)" % ", ".join(
+                        "(%s)" % column.compile(dialect=dialect)
+                        for column in columns))))
+    if skipped_nulls:
+        groups = groups.having(not_(or_(*skipped_nulls)))
+    groups = groups.alias("groups")
+
+    # in a set, the other facet columns are NULL, so ordering by all of them
+    # orders the groups of the same count by value
+    rank = func.row_number().over(
+        partition_by=groups.c.grouping_mask,
+        order_by=[desc(groups.c.count)]
+        + [groups.c[label] for label in labels]).label("rank")
+    ranked_columns = [groups, rank]
+    if with_totals:
+        ranked_columns.append(func.count().over(
+                partition_by=groups.c.grouping_mask).label("total"))
+    ranked = select(ranked_columns).alias("ranked")
+    query = select([ranked])
+    if max_items is not None:
+        query = query.where(ranked.c.rank <= max_items + 1)
+
+    counters = dict((name, Counter()) for name in names)
+    totals = dict((name, 0 if with_totals else None) for name in names)
+    for row in session.execute(query):
+        i = masks.index(row.grouping_mask)
+        counters[names[i]][row[i]] = row.count
+        if with_totals:
+            totals[names[i]] = row.total
+    return dict((name, _top(counters[name], max_items, totals[name]))
+                for name in names)
+
+def count_facets(session, facets, clauses, max_items=None,
+                 with_totals=False):
+    """
+    facets is a dict: facet name -> (column name in the search table, True
+    if the results without value must be counted).
+    Returns a dict: facet name -> (items, is_sliced, total), items being the
+    list of (value, count) of the max_items values with the most results
+    matching clauses, is_sliced True if there are more values, and total
+    the number of values if with_totals is True, None otherwise.
+    """
+    columns = dict((name, t_result_search.c[column])
+                   for (name, (column, nulls)) in facets.items())
+    return _count(session, columns, None, facets, clauses, max_items,
+                  with_totals)
+
+def count_cube_facets(session, facets, clauses, max_items=None,
+                      with_totals=False):
+    """
+    The same as count_facets(), on the facet cube: the columns of facets and
+    clauses must be in firewoes.lib.search.CUBE_DIMENSIONS.
+    """
+    columns = dict((name, cube_value(t_facet_cube.c[column]))
+                   for (name, (column, nulls)) in facets.items())
+    return _count(session, columns, t_facet_cube.c["count"], facets,
+                  clauses, max_items, with_totals)
+
+def _count(session, columns, weight, facets, clauses, max_items,
+           with_totals):
+    """
+    columns is a dict: facet name -> its column expression.
+    """
+    if not facets:
+        return {}
+    if session.bind.dialect.name == "postgresql":
+        return _grouping_sets(session, columns, weight, facets, clauses,
+                              max_items, with_totals)
+    return _scan(session, columns, weight, facets, clauses, max_items,
+                 with_totals)
@@ -16,14 +16,14 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from models import to_dict
+from facets import count_facets, count_cube_facets
 
-from firewoes.lib.orm import Analysis, Issue, Failure, Info, Result, \
-    Generator, Sut, Metadata, Message, Location, File, Point, Range, Function
 from firewoes.lib.debianutils import DebianPackagePeopleMapping, \
     emails_for_person
+from firewoes.lib.search import t_result_search, t_facet_cube, \
+    CUBE_DIMENSIONS, text_match, text_words
 
-from sqlalchemy import func, desc, and_
+from sqlalchemy import and_, select
 
 class Menu(object):
     """
@@ -38,7 +38,9 @@ class Menu(object):
         in the form name=value, e.g. generator_name="coccinelle".
         """
         self.filters = []
-        self.clauses = []
+        self.search_clauses = [] # the clauses of the active filters
+        # the same, on the facet cube (None if they can't be expressed there)
+        self.cube_clauses = []
         
         # we clean the active filters, removing blank values:
         self.active_filters_dict = dict((k, v)
@@ -62,7 +64,12 @@ class Menu(object):
                 
                 self.filters.append(new_filter)
                 if new_filter.is_active():
-                    self.clauses += new_filter.get_clauses()
+                    self.search_clauses += new_filter.get_search_clauses()
+                    cube_clauses = new_filter.get_cube_clauses()
+                    if cube_clauses is None or self.cube_clauses is None:
+                        self.cube_clauses = None
+                    else:
+                        self.cube_clauses += cube_clauses
             else:
                 # if there was an irrelevant filter in active_filters_dict,
                 # we remove it:
@@ -72,21 +79,40 @@ class Menu(object):
                     pass
 
     
-    def filter_sqla_query(self, query):
+    def filter_search_query(self, query):
         """
-        Filters the query by all active filters, and returns a new
-        SQLAlchely query.
+        Filters a query on the search table (see firewoes.lib.search) by all
+        active filters, and returns a new SQLAlchemy query.
         """
-        query = query.filter(and_(*self.clauses))
-        return query
+        return query.filter(and_(*self.search_clauses))
     
-    def get(self, session, max_items=None):
+    def get(self, session, max_items=None, with_totals=False):
         """
         Returns the menu in form of a list of filters.
         Needs a SQLAlchemy session for the filters, in their items generation.
+        The items of all the inactive filters are counted at once, see
+        firewoes.web.app.frontend.facets. If with_totals is True, the
+        number of distinct values of each filter is added as "total".
         """
-        return [filter_.get(session, self.active_filters_dict,
-                            clauses=self.clauses, max_items=max_items)
+        facets = dict((filter_.name, filter_.get_facet())
+                      for filter_ in self.filters
+                      if not filter_.is_active()
+                      and filter_.get_facet() is not None)
+        # the facets of the cube dimensions are counted on the facet cube,
+        # if the active filters can be applied there
+        cube_facets = {}
+        if self.cube_clauses is not None:
+            for (name, facet) in facets.items():
+                if facet[0] in CUBE_DIMENSIONS:
+                    cube_facets[name] = facets.pop(name)
+        counts = count_facets(session, facets, self.search_clauses,
+                              max_items=max_items, with_totals=with_totals)
+        counts.update(count_cube_facets(session, cube_facets,
+                                        self.cube_clauses,
+                                        max_items=max_items,
+                                        with_totals=with_totals))
+        return [filter_.get(self.active_filters_dict,
+                            facet=counts.get(filter_.name))
                 for filter_ in self.filters]
     
     def __repr__(self):
@@ -110,28 +136,45 @@ class Filter(object):
             self.is_sliced = False # sliced if max_items > number of items
         self.name = name
     
-    def get_clauses(self):
+    def get_search_clauses(self):
         """
-        Returns the SQLAlchemy clauses for this filter.
+        Returns the SQLAlchemy clauses for this filter, on the search table.
         """
         raise NotImplementedError
     
-    def get_items(self, session, clauses=None, max_items=None):
+    def get_cube_clauses(self):
         """
-        Returns the subitems of the menu (only for inactive filters).
+        Returns the SQLAlchemy clauses for this filter on the facet cube,
+        or None if the filter isn't one of its dimensions.
         """
-        raise NotImplementedError
+        return None
+    
+    def get_facet(self):
+        """
+        Returns (column name in the search table, True if the results without
+        value are counted) if the items can be counted on the search table,
+        None otherwise.
+        """
+        return None
     
-    def get(self, session, active_filters_dict, clauses=None, max_items=None):
+    def get(self, active_filters_dict, facet=None):
         """
         Returns the filter with its attributes.
+        facet is the (items, is_sliced, total) counted for this filter by the
+        menu, None if the filter has no items (see get_facet).
         """
         res = dict(active=self.active,
                    name=self._cool_name or self.name)
         
         if not self.active:
-            res["items"] = self.get_items(session, clauses=clauses,
-                                          max_items=max_items)
+            if facet is not None:
+                (items, self.is_sliced, total) = facet
+                res["items"] = [dict(value=value, count=count)
+                                for (value, count) in items]
+                if total is not None:
+                    res["total"] = total
+            else:
+                res["items"] = []
             res["is_sliced"] = self.is_sliced
             
             # for each item we add its link:
@@ -168,38 +211,27 @@ class Filter(object):
         return string
 
 class FilterFirehoseAttribute(Filter):
+    _search_column = None # name of the column in the search table
+    # False if a NULL value means that the result hasn't the attribute's
+    # object at all (e.g. no Sut), these results are then not counted
+    _facet_nulls = True
+    
+    def get_search_clauses(self):
+        return [(t_result_search.c[self._search_column] == self.value)]
+    
+    def get_cube_clauses(self):
+        if self._search_column not in CUBE_DIMENSIONS:
+            return None
+        return [(t_facet_cube.c[self._search_column] == self.value)]
+    
+    def get_facet(self):
+        return (self._search_column, self._facet_nulls)
+    
     def is_relevant(self, active_keys=None):
         for dep in self._dependencies:
             if dep not in active_keys:
                 return False
         return True
-    
-    def joins(self, query):
-        raise NotImplementedError
-    
-    def group_by(self, session, attribute, outerjoins, clauses=None,
-                 max_items=None):
-        query = session.query(attribute.label("value"),
-                              func.count(Result.id).label("count"))
-        
-        for join in outerjoins:
-            query = query.outerjoin(join[0], join[1])
-        
-        if clauses is not None:
-            query = query.filter(and_(*clauses))
-        query = (query
-               .group_by(attribute)
-               .order_by(desc("count"))
-                 )
-
-        # slicing
-        if max_items is not None:
-            number_of_all_results = query.count()
-            if number_of_all_results > max_items:
-                query = query.limit(max_items)
-                self.is_sliced = True
-        
-        return query.all()
 
 ##################################################
 # real world filters:
@@ -209,204 +241,86 @@ class FilterFirehoseAttribute(Filter):
 
 class FilterErrorType(FilterFirehoseAttribute):
     _dependencies = []
-    _outerjoins = [
-        (Location, Result.location_id==Location.id),
-        (File, Location.file_id==File.id),
-        (Function, Location.function_id==Function.id),
-        (Analysis, Result.analysis_id == Analysis.id),
-        (Metadata, Analysis.metadata_id==Metadata.id),
-        (Sut, Metadata.sut_id==Sut.id),
-        (Generator, Metadata.generator_id==Generator.id),
-        ]
     _cool_name = "Error type"
-    
-    def get_clauses(self):
-        return [(Result.type == self.value)]
-    
-    def get_items(self, session, clauses=None, max_items=None):
-        res = self.group_by(session, Result.type, self._outerjoins,
-                            clauses=clauses, max_items=max_items)
-        return to_dict(res)
+    _search_column = "result_type"
 
 ### GENERATOR ###
 
-class FilterGenerator(FilterFirehoseAttribute):
-    _outerjoins = [
-        (Metadata, Metadata.generator_id==Generator.id),
-        (Sut, Metadata.sut_id==Sut.id),
-        (Analysis, Analysis.metadata_id == Metadata.id),
-        (Result, Result.analysis_id == Analysis.id),
-        (Location, Result.location_id==Location.id),
-        (Function, Location.function_id==Function.id),
-        (File, Location.file_id==File.id),
-        ]
-
-class FilterGeneratorName(FilterGenerator):
+class FilterGeneratorName(FilterFirehoseAttribute):
     _dependencies = []
     _cool_name = "Generator"
+    _search_column = "generator_name"
     
-    def get_clauses(self):
-        return [(Generator.name == self.value)]
-    
-    def get_items(self, session, clauses=None, max_items=None):
-        res = self.group_by(session, Generator.name, self._outerjoins,
-                            clauses=clauses, max_items=max_items)
-        return to_dict(res)
-    
-class FilterGeneratorVersion(FilterGenerator):
+class FilterGeneratorVersion(FilterFirehoseAttribute):
     _dependencies = ["generator_name"]
     _cool_name = "Generator version"
-    
-    def get_clauses(self):
-        return [(Generator.version == self.value)]
-    
-    def get_items(self, session, clauses=None, max_items=None):
-        res = self.group_by(session, Generator.version, self._outerjoins,
-                            clauses=clauses, max_items=max_items)
-        return to_dict(res)
+    _search_column = "generator_version"
 
 ### SUT ###
 
-class FilterSut(FilterFirehoseAttribute):
-    _outerjoins = [
-        (Metadata, Metadata.sut_id==Sut.id),
-        (Generator, Metadata.generator_id==Generator.id),
-        (Analysis, Analysis.metadata_id == Metadata.id),
-        (Result, Result.analysis_id == Analysis.id),
-        (Location, Result.location_id==Location.id),
-        (Function, Location.function_id==Function.id),
-        (File, Location.file_id==File.id),
-        ]
-
-class FilterSutType(FilterSut):
+class FilterSutType(FilterFirehoseAttribute):
     _dependencies = []
     _cool_name = "Type"
-    
-    def get_clauses(self):
-        return [(Sut.type == self.value)]
-    
-    def get_items(self, session, clauses=None, max_items=None):
-        res = self.group_by(session, Sut.type, self._outerjoins,
-                            clauses=clauses, max_items=max_items)
-        return to_dict(res)
-
+    _search_column = "sut_type"
+    _facet_nulls = False
 
-class FilterSutName(FilterSut):
+class FilterSutName(FilterFirehoseAttribute):
     _dependencies = []
     _cool_name = "Package"
-    
-    def get_clauses(self):
-        return [(Sut.name == self.value)]
-    
-    def get_items(self, session, clauses=None, max_items=None):
-        res = self.group_by(session, Sut.name, self._outerjoins,
-                            clauses=clauses, max_items=max_items)
-        return to_dict(res)
+    _search_column = "sut_name"
+    _facet_nulls = False
 
-class FilterSutVersion(FilterSut):
+class FilterSutVersion(FilterFirehoseAttribute):
     _dependencies = ["sut_name"]
     _cool_name = "Package version"
-    
-    def get_clauses(self):
-        return [(Sut.version == self.value)]
-    
-    def get_items(self, session, clauses=None, max_items=None):
-        res = self.group_by(session, Sut.version, self._outerjoins,
-                            clauses=clauses, max_items=max_items)
-        return to_dict(res)
+    _search_column = "sut_version"
+    _facet_nulls = False
 
-class FilterSutRelease(FilterSut):
+class FilterSutRelease(FilterFirehoseAttribute):
     _dependencies = ["sut_name"]
     _cool_name = "Package release"
-    
-    def get_clauses(self):
-        return [(Sut.release == self.value)]
-    
-    def get_items(self, session, clauses=None, max_items=None):
-        res = self.group_by(session, Sut.release, self._outerjoins,
-                            clauses=clauses, max_items=max_items)
-        return to_dict(res)
+    _search_column = "sut_release"
 
-class FilterSutBuildarch(FilterSut):
+class FilterSutBuildarch(FilterFirehoseAttribute):
     _dependencies = ["sut_name"]
     _cool_name = "Package buildarch"
-    
-    def get_clauses(self):
-        return [(Sut.buildarch == self.value)]
-    
-    def get_items(self, session, clauses=None, max_items=None):
-        res = self.group_by(session, Sut.buildarch, self._outerjoins,
-                            clauses=clauses, max_items=max_items)
-        return to_dict(res)
+    _search_column = "sut_buildarch"
 
 ### LOCATION ###
 
 class FilterLocationFile(FilterFirehoseAttribute):
     _dependencies = ["sut_name"]
-    _outerjoins = [
-        (Location, Location.file_id==File.id),
-        (Function, Location.function_id==Function.id),
-        (Result, Result.location_id==Location.id),
-        (Analysis, Result.analysis_id == Analysis.id),
-        (Metadata, Analysis.metadata_id==Metadata.id),
-        (Sut, Metadata.sut_id==Sut.id),
-        (Generator, Metadata.generator_id==Generator.id),
-        ]
     _cool_name = "File"
-    
-    def get_clauses(self):
-        return [(File.givenpath == self.value),
-                (Location.file_id==File.id)]
-    
-    def get_items(self, session, clauses=None, max_items=None):
-        res = self.group_by(session, File.givenpath, self._outerjoins,
-                            clauses=clauses, max_items=max_items)
-        return to_dict(res)
+    _search_column = "location_file"
+    _facet_nulls = False
 
 class FilterLocationFunction(FilterFirehoseAttribute):
     _dependencies = ["sut_name", "location_file"]
-    _outerjoins = [
-        (Location, Location.function_id==Function.id),
-        (File, Location.file_id==File.id),
-        (Result, Result.location_id==Location.id),
-        (Analysis, Result.analysis_id == Analysis.id),
-        (Metadata, Analysis.metadata_id==Metadata.id),
-        (Sut, Metadata.sut_id==Sut.id),
-        (Generator, Metadata.generator_id==Generator.id),
-        ]
     _cool_name = "Function"
-    
-    def get_clauses(self):
-        return [(Function.name == self.value),
-                (Location.function_id == Function.id)]
-    
-    def get_items(self, session, clauses=None, max_items=None):
-        res = self.group_by(session, Function.name, self._outerjoins,
-                            clauses=clauses, max_items=max_items)
-        return to_dict(res)
+    _search_column = "location_function"
+    _facet_nulls = False
 
 ### TESTID ###
 
 class FilterTestId(FilterFirehoseAttribute):
     _dependencies = ["generator_name"]
-    _outerjoins = [
-        (Location, Result.location_id==Location.id),
-        (File, Location.file_id==File.id),
-        (Function, Location.function_id==Function.id),
-        (Analysis, Result.analysis_id == Analysis.id),
-        (Metadata, Analysis.metadata_id==Metadata.id),
-        (Sut, Metadata.sut_id==Sut.id),
-        (Generator, Metadata.generator_id==Generator.id),
-        ]
     _cool_name = "Test id"
+    _search_column = "testid"
+
+### MESSAGE ###
+
+# full-text search in the messages and notes of the results
+class FilterMessage(Filter):
+    _cool_name = "Message"
     
-    def get_clauses(self):
-        return [(Result.testid == self.value)]
+    def get_search_clauses(self):
+        words = text_words(self.value)
+        if not words:
+            return []
+        return [text_match(words)]
     
-    def get_items(self, session, clauses=None, max_items=None):
-        res = self.group_by(session, Result.testid, self._outerjoins,
-                            clauses=clauses, max_items=max_items)
-        return to_dict(res)
+    def is_relevant(self, active_keys=None):
+        return True
 
 ### BY DEVELOPER ###
 
@@ -414,13 +328,11 @@ class FilterTestId(FilterFirehoseAttribute):
 class FilterByMaintainerPackages(Filter):
     _cool_name = "Maintainer"
     
-    def get_clauses(self):
-        return [(DebianPackagePeopleMapping.maintainer_email.in_(
-                 emails_for_person(self.value))),
-                (Sut.name == DebianPackagePeopleMapping.package_name)]
-    
-    def get_items(self, session, clauses=None, max_items=None):
-        return []
+    def get_search_clauses(self):
+        return [t_result_search.c.sut_name.in_(
+                select([DebianPackagePeopleMapping.package_name]).where(
+                    DebianPackagePeopleMapping.maintainer_email.in_(
+                        emails_for_person(self.value))))]
     
     def is_relevant(self, active_keys=None):
         return True
@@ -439,6 +351,7 @@ all_filters = [
     ("location_file", FilterLocationFile),
     ("location_function", FilterLocationFunction),
     ("testid", FilterTestId),
+    ("message", FilterMessage),
     ]
 
 
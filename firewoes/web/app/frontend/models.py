@@ -17,12 +17,19 @@
 
 
 from firewoes.lib.orm import Analysis, Issue, Failure, Info, Result, \
-    Generator, Sut, Metadata, Message, Location, File, Point, Range, Function
-from firewoes.lib.debianutils import DebianPackagePeopleMapping, DebianMaintainer
+    Generator, Sut, Metadata, Point, Range
+from firewoes.lib.search import t_result_search, t_facet_cube, CUBE_MISSING
+from firewoes.lib.serialize import serialize
 
-from sqlalchemy import and_, func, desc
+from sqlalchemy import and_, func, desc, select
+
+import json
+import random
+import re
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 
 from firewoes.web.app import session, app
+from suggestions import suggestions as suggestions_index
 
 
 ### EXCEPTIONS ###
@@ -34,10 +41,41 @@ class Http404Error(Exception): pass
 ### MODEL CLASSES ###
 
 
+def encode_cursor(result_id):
+    """
+    Returns the "after" token of the page following the result result_id.
+    """
+    return urlsafe_b64encode(result_id.encode("utf-8")).rstrip("=")
+
+# the result ids are hex sha1 digests (see firewoes.lib.hash)
+_result_id_re = re.compile(r"^[0-9a-f]{40}$")
+
+def decode_cursor(token):
+    """
+    Returns the result id of an "after" token, see encode_cursor.
+    """
+    try:
+        result_id = urlsafe_b64decode(token.encode("ascii")
+                                      + "=" * (-len(token) % 4))
+    except (TypeError, UnicodeError):
+        result_id = None
+    # urlsafe_b64decode ignores the characters out of its alphabet
+    if result_id is None or not _result_id_re.match(result_id):
+        raise Http404Error("Invalid cursor: %s" % token)
+    return result_id.decode("ascii")
+
+
+def _suggestions_index():
+    """
+    Returns the index of the package and maintainer names, up to date.
+    """
+    return suggestions_index.update(session)
+
+
 def to_dict(elem):
     """
     serializes a SQLAchemy response into a dict
-    /!\ backrefs are followed and can do infinite recursion TODO
+    (the mapped objects are serialized by firewoes.lib.serialize)
     """
     if elem is None:
         return None
@@ -53,15 +91,35 @@ def to_dict(elem):
             res[attr_name] = to_dict(elem[attr_name])
         return res
     else:
-        res = dict()
-        cls = type(elem)
-        for attr_name in cls._sa_class_manager.local_attrs:
-                attr = getattr(elem, attr_name)
-                #if type(attr) in [int, float, str, unicode]:#_string_type]
-                #    res[attr_name] = attr
-                #else:
-                res[attr_name] = to_dict(attr)
-        return res
+        return serialize(elem)
+
+
+def capped_count(query, max_count):
+    """
+    Counts the rows of query, but stops at max_count.
+    Returns (count, True if there are more rows than count).
+    """
+    limited = query.order_by(None).limit(max_count + 1).subquery()
+    count = session.query(func.count()).select_from(limited).scalar()
+    if count > max_count:
+        return (max_count, True)
+    return (count, False)
+
+def estimated_count(query):
+    """
+    Returns the number of rows of query estimated by the PostgreSQL planner,
+    or None with other databases.
+    """
+    connection = session.connection()
+    if connection.dialect.name != "postgresql":
+        return None
+    statement = query.order_by(None).statement.compile(
+        dialect=connection.dialect)
+    plan = connection.execute("EXPLAIN (FORMAT JSON) %s" % statement,
+                              statement.params).scalar()
+    if isinstance(plan, basestring): # psycopg2 < 2.5 doesn't parse json
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
 
 
 class FHGeneric(object):
@@ -129,15 +187,28 @@ class Sut_app(FHGeneric):
     
     def name_contains(self, name, limit=None):
         """ returns the packages whose name contains name """
-        elems = session.query(Sut.name).filter(
-            Sut.name.contains(name)).distinct()
-        if limit is None:
-            elems = elems.all()
-        else:
-            elems = elems.limit(limit)
+        index = _suggestions_index().packages
         # we remove 'name' if it's here
-        elems = [e for e in elems if e.name != name]
-        return to_dict(elems)
+        names = index.search(name, limit=limit + 1 if limit else limit)
+        names = [elem for elem in names if elem != name][:limit]
+        return [dict(name=elem) for elem in names]
+
+    def complete(self, prefix, limit):
+        """
+        Returns the package names beginning with prefix, with their number
+        of results, without querying the db (but for the generation, at most
+        every COMPLETE_MAX_AGE seconds).
+        """
+        index = suggestions_index.update(
+            session, max_age=app.config["COMPLETE_MAX_AGE"]).packages
+        return [dict(name=name, count=count)
+                for (name, count) in index.complete(prefix, limit)]
+
+# the columns of the exported results (see Result_app.export)
+EXPORT_COLUMNS = ["id", "result_type", "testid", "message_text",
+                  "location_file", "location_function", "line",
+                  "sut_type", "sut_name", "sut_version", "sut_release",
+                  "sut_buildarch", "generator_name", "generator_version"]
 
 class Result_app(FHGeneric):
     def __init__(self):
@@ -150,33 +221,44 @@ class Result_app(FHGeneric):
     def with_most_results(self, limit=5):
         """
         Returns the list of packages which have the most results.
+        The counts are read from the facet cube, which is kept up to date
+        at ingestion time, instead of grouping the whole results table.
         """
-        elems = (session.query(Sut.name, func.count(Result.id).label("count"))
-                 .filter(Result.analysis_id == Analysis.id)
-                 .filter(Analysis.metadata_id == Metadata.id)
-                 .filter(Metadata.sut_id == Sut.id)
-                 .group_by(Sut.name)
-                 .order_by(desc("count"))
-                 .limit(limit)
-                 .all()
-                 )
-        return to_dict(elems)
+        count = func.sum(t_facet_cube.c["count"]).label("count")
+        elems = session.execute(
+            select([t_facet_cube.c.sut_name.label("name"), count])
+            .where(t_facet_cube.c.sut_name != CUBE_MISSING)
+            .group_by(t_facet_cube.c.sut_name)
+            .order_by(desc("count"))
+            .limit(limit))
+        return [dict(name=row.name, count=int(row.count)) for row in elems]
     
     def random_results(self, limit=5):
         """
-        Returns the last results.
+        Returns limit random results (fewer if there aren't enough).
+        The ids being hashes, they're evenly spread: each result is the
+        first one whose id follows a random id, which is a single index
+        lookup, whatever the size of the db.
         """
-        elems = (session.query(Result.id, Message.text, Sut.name)
-                 .filter(Result.message_id == Message.id)
-                 .filter(Result.analysis_id == Analysis.id)
-                 .filter(Analysis.metadata_id == Metadata.id)
-                 .filter(Metadata.sut_id == Sut.id)
-                 .order_by(func.random())
-                 # PostgreSQL-specific, maybe func.rand() for other back-ends
-                 .limit(limit)
-                 .all()
-                 )
-        return to_dict(elems)
+        search = t_result_search.c
+        query = (session.query(search.result_id.label("id"),
+                               search.message_text.label("text"),
+                               search.sut_name.label("name"))
+                 .filter(search.message_text != None)
+                 .order_by(search.result_id))
+        results = dict()
+        # a few more probes, in case several fall on the same result
+        for i in range(limit * 2):
+            if len(results) == limit:
+                break
+            probe = "%040x" % random.getrandbits(160)
+            elem = (query.filter(search.result_id >= probe).first()
+                    # we wrap around, to the first result
+                    or query.first())
+            if elem is None: # no results at all
+                break
+            results[elem.id] = elem
+        return to_dict(results.values())
     
     def _suggestions(self, current_args):
         """
@@ -184,40 +266,61 @@ class Result_app(FHGeneric):
         results.
         """
         if current_args.get("sut_name"):
-            elems = (session.query(Sut.name,
-                                   func.count(Result.id).label("count"))
-                     .filter(Sut.name.contains(current_args["sut_name"]))
-                     .filter(Result.analysis_id == Analysis.id)
-                     .filter(Analysis.metadata_id == Metadata.id)
-                     .filter(Metadata.sut_id == Sut.id)
-                     .group_by(Sut.name)
-                     .order_by(desc("count"))
-                     .all()
-                     )
-            suggestions = [dict(sut_name=sut.name) for sut in elems]
+            names = _suggestions_index().packages.search(
+                current_args["sut_name"], min_count=1,
+                limit=app.config["SEARCH_SUGGESTIONS_MAX_NUMBER"])
+            suggestions = [dict(sut_name=name) for name in names]
         elif current_args.get("maintainer"):
-            elems = (session.query(DebianMaintainer.name,
-                                   func.count(Result.id).label("count"))
-                     .filter(DebianMaintainer.name.ilike(
-                        "%" + current_args["maintainer"] + "%"))
-                     # maybe postgresql-specific
-                     .filter(Result.analysis_id == Analysis.id)
-                     .filter(Analysis.metadata_id == Metadata.id)
-                     .filter(Metadata.sut_id == Sut.id)
-                     .filter(Sut.name == DebianPackagePeopleMapping.package_name)
-                     .filter(DebianPackagePeopleMapping.maintainer_email ==
-                             DebianMaintainer.email)
-                     .group_by(DebianMaintainer.name)
-                     .order_by(desc("count"))
-                     .all()
-                     )
-            suggestions = [dict(maintainer=maint.name) for maint in elems]
+            names = _suggestions_index().maintainers.search(
+                current_args["maintainer"], min_count=1,
+                limit=app.config["SEARCH_SUGGESTIONS_MAX_NUMBER"])
+            suggestions = [dict(maintainer=name) for name in names]
             
         else:
             suggestions = []
         
         return suggestions
     
+    def _with_locations(self, results):
+        """
+        Replaces the point_id and range_id of results (rows of the search
+        table) by their Point and Range.
+        """
+        def by_id(cls, ids):
+            ids = set(id for id in ids if id is not None)
+            if not ids:
+                return {}
+            return dict((elem.id, to_dict(elem)) for elem in
+                        session.query(cls).filter(cls.id.in_(ids)).all())
+        
+        points = by_id(Point, [res["point_id"] for res in results])
+        ranges = by_id(Range, [res["range_id"] for res in results])
+        for res in results:
+            res["Point"] = points.get(res.pop("point_id"))
+            res["Range"] = ranges.get(res.pop("range_id"))
+        return results
+    
+    def export(self, request_args):
+        """
+        Yields all the results matching the filters of request_args, as
+        dicts of EXPORT_COLUMNS, in the order of their ids.
+        They're fetched by batches of EXPORT_BATCH_SIZE, with a server-side
+        cursor where the db supports it, so that memory usage doesn't depend
+        on the number of results.
+        """
+        import filters
+        
+        rs = t_result_search.c
+        query = session.query(*[rs.result_id.label("id") if name == "id"
+                                else rs[name] for name in EXPORT_COLUMNS])
+        query = filters.Menu(request_args.copy()).filter_search_query(query)
+        query = (query
+                 .order_by(rs.result_id)
+                 .execution_options(stream_results=True)
+                 .yield_per(app.config["EXPORT_BATCH_SIZE"]))
+        for row in query:
+            yield row._asdict()
+    
     def filter(self, request_args, offset=None):
         """
         returns the results corresponding to the args in request_args,
@@ -231,34 +334,47 @@ class Result_app(FHGeneric):
         
         # we need the arguments without "page" for the menu
         # ("page" would add page=foo on the menu links, which we don't want)
+        # (nor "after": a new filter starts a new list of results)
         args_without_page = request_args.copy()
-        try:
-            del(args_without_page["page"])
-        except:
-            pass
+        for arg in ["page", "after"]:
+            try:
+                del(args_without_page[arg])
+            except:
+                pass
         
-        query = (session.query(
-                Result.id,
-                Result.type.label("result_type"),
-                File.givenpath.label("location_file"),
-                Function.name.label("location_function"),
-                Message.text.label("message_text"),
-                Message.id.label("message_id"),
-                Point, Range,
-                Sut.name.label("sut_name"),
-                Sut.version.label("sut_version"),
-                Sut.type.label("sut_type"),
-                Sut.release.label("sut_release"),
-                Sut.buildarch.label("sut_buildarch"),
-                Generator.name.label("generator_name"),
-                Generator.version.label("generator_version"),
-                Result.testid.label("testid"))
-            .outerjoin(Location, File, Function, Point, Analysis,
-                       Metadata, Generator, Sut, Message)
-            .outerjoin(Range, Location.range_id==Range.id)
-                 )
+        # the results come from the search table, without any join
+        rs = t_result_search.c
+        query = session.query(
+            rs.result_id.label("id"),
+            rs.result_type,
+            rs.location_file,
+            rs.location_function,
+            rs.message_text,
+            rs.message_id,
+            rs.point_id,
+            rs.range_id,
+            rs.sut_name,
+            rs.sut_version,
+            rs.sut_type,
+            rs.sut_release,
+            rs.sut_buildarch,
+            rs.generator_name,
+            rs.generator_version,
+            rs.testid)
         menu = filters.Menu(args_without_page)
-        query = menu.filter_sqla_query(query)
+        query = menu.filter_search_query(query)
+        
+        # the count of all the results, unless asked (?exact_count=1), stops
+        # at SEARCH_COUNT_MAX
+        if request_args.get("exact_count"):
+            (results_all_count, count_is_capped) = (query.count(), False)
+        else:
+            (results_all_count, count_is_capped) = capped_count(
+                query, app.config["SEARCH_COUNT_MAX"])
+        if count_is_capped:
+            results_estimated_count = estimated_count(query)
+        else:
+            results_estimated_count = None
         
         # we get the page number and the offset
         try:  page = int(request_args["page"])
@@ -267,14 +383,35 @@ class Result_app(FHGeneric):
         try: offset = int(request_args["offset"])
         except: offset = offset or app.config["SEARCH_RESULTS_OFFSET"]
         
-        # we calculate the range of results
-        start = (page - 1) * offset
+        # the results are ordered by id, a page starts either after the
+        # result whose id is in the "after" token (keyset pagination, whose
+        # cost doesn't depend on the depth), or at an offset given by the
+        # page number
+        query = query.order_by(t_result_search.c.result_id)
+        after = request_args.get("after")
+        if after:
+            query = query.filter(
+                t_result_search.c.result_id > decode_cursor(after))
+            page = None
+            start = 0
+        else:
+            start = (page - 1) * offset
         end = start + offset
         
+        # the number of values of each filter, only if asked
+        # (e.g. /api/search/?facet_totals=1)
+        with_totals = bool(request_args.get("facet_totals"))
         menu=menu.get(session,
-                      max_items=app.config["SEARCH_MENU_MAX_NUMBER_OF_ELEMENTS"])
-        results_all_count = query.count()
-        results=to_dict(query.slice(start, end).all())
+                      max_items=app.config["SEARCH_MENU_MAX_NUMBER_OF_ELEMENTS"],
+                      with_totals=with_totals)
+        # one more result tells if there's a next page
+        results = to_dict(query.slice(start, end + 1).all())
+        if len(results) > offset:
+            results = results[:offset]
+            next_ = encode_cursor(results[-1]["id"])
+        else:
+            next_ = None
+        results = self._with_locations(results)
         
         # do we need to suggest things?
         if len(results) == 0:
@@ -288,9 +425,17 @@ class Result_app(FHGeneric):
                     page=page,
                     offset=offset,
                     results_all_count=results_all_count,
-                    results_range = (start+1, start+len(results)),
+                    # True if there are more than results_all_count results:
+                    results_count_is_capped=count_is_capped,
+                    # the planner's estimate, if capped (PostgreSQL only):
+                    results_estimated_count=results_estimated_count,
+                    # unknown with a cursor:
+                    results_range = (None if page is None else
+                                     (start+1, start+len(results))),
                     # to avoid 1-10 of 5 results
                     suggestions=suggestions,
+                    after=after or None,
+                    next=next_, # the "after" token of the next page
                     )
 
 class Report(object):
@@ -3,25 +3,57 @@
 from math import ceil
 
 class Pagination(object):
-    def __init__(self, page, per_page, total_count):
+    def __init__(self, page, per_page, total_count, max_page=None, next=None,
+                 total_is_capped=False):
+        """
+        page is None for a page reached with an "after" token (see
+        Result_app.filter), max_page the last page linked by its number,
+        and next the "after" token of the next page, if any.
+        total_is_capped is True if there are more than total_count items:
+        the pages after the last counted one are reached with next.
+        """
         self.page = page
         self.per_page = per_page
         self.total_count = total_count
+        self.max_page = max_page
+        self.next = next
+        self.total_is_capped = total_is_capped
+
+    @property
+    def total(self):
+        """
+        The total number of items, to be displayed, e.g. "10000+".
+        """
+        if self.total_is_capped:
+            return "%d+" % self.total_count
+        return "%d" % self.total_count
 
     @property
     def pages(self):
-        return int(ceil(self.total_count / float(self.per_page)))
+        pages = int(ceil(self.total_count / float(self.per_page)))
+        if self.max_page is not None:
+            pages = min(pages, self.max_page)
+        return pages
+
+    @property
+    def has_cursor_next(self):
+        """
+        True if the next page is only reachable with the "after" token.
+        """
+        return self.next is not None and not self.has_next
 
     @property
     def has_prev(self):
-        return self.page > 1
+        return self.page is not None and self.page > 1
 
     @property
     def has_next(self):
-        return self.page < self.pages
+        return self.page is not None and self.page < self.pages
 
     def iter_pages(self, left_edge=2, left_current=5,
                    right_current=5, right_edge=2):
+        if self.page is None:
+            return
         last = 0
         for num in xrange(1, self.pages + 1):
             if num <= left_edge or \
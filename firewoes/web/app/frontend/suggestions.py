@@ -0,0 +1,185 @@
+# Copyright (C) 2013  Matthieu Caneill <matthieu.caneill@gmail.com>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+The suggestions of package and maintainer names, given a part of a name,
+and the completions of package names, given their beginning.
+The names and their numbers of results are loaded in memory, in a trigram
+index, which is built again when the data generation changes.
+"""
+
+from collections import defaultdict
+from bisect import bisect_left
+import heapq
+import threading
+import time
+
+from sqlalchemy import select, func
+from sqlalchemy.exc import SQLAlchemyError
+
+from firewoes.lib.orm import t_sut
+from firewoes.lib.search import t_facet_cube, CUBE_MISSING
+from firewoes.lib.debianutils import DebianMaintainer, \
+    DebianPackagePeopleMapping
+from firewoes.web.app.cache import request_version
+
+def _trigrams(string):
+    return set(string[i:i+3] for i in range(len(string) - 2))
+
+class TrigramIndex(object):
+    """
+    An index of names, which finds the ones containing a given string
+    (case insensitive).
+    """
+    def __init__(self, counts):
+        """
+        counts is a dict: name -> number of results.
+        """
+        # the names are numbered by decreasing number of results, so that
+        # the lists of the index are sorted the same way
+        self.names = sorted((name for name in counts if name is not None),
+                            key=lambda name: (-counts[name], name))
+        self.counts = [counts[name] for name in self.names]
+        self.lowered = [name.lower() for name in self.names]
+        self.trigrams = defaultdict(list) # trigram -> numbers of the names
+        for (i, name) in enumerate(self.lowered):
+            for trigram in _trigrams(name):
+                self.trigrams[trigram].append(i)
+        # for the completions: (lowered name, number) in alphabetical order
+        self.alphabetical = sorted((name, i)
+                                   for (i, name) in enumerate(self.lowered))
+
+    def search(self, string, limit=None, min_count=0):
+        """
+        Returns the names containing string and having at least min_count
+        results, the ones with the most results first.
+        """
+        if limit is not None and limit <= 0:
+            return []
+        string = string.lower()
+        trigrams = _trigrams(string)
+        if trigrams:
+            # a name containing string has all its trigrams: the shortest
+            # list of names is enough
+            candidates = min((self.trigrams.get(trigram, [])
+                              for trigram in trigrams), key=len)
+        else: # too short, we look at all the names
+            candidates = xrange(len(self.names))
+        names = []
+        for i in candidates:
+            if self.counts[i] < min_count:
+                break
+            if string in self.lowered[i]:
+                names.append(self.names[i])
+                if len(names) == limit:
+                    break
+        return names
+
+    def complete(self, prefix, limit=None):
+        """
+        Returns the (name, count) of the names beginning with prefix, the
+        ones with the most results first.
+        """
+        if limit is not None and limit <= 0:
+            return []
+        prefix = prefix.lower()
+        start = bisect_left(self.alphabetical, (prefix,))
+        end = bisect_left(self.alphabetical, (prefix + u"\uffff",), start)
+        matches = end - start
+        if limit is not None and matches * matches > limit * len(self.names):
+            # a short prefix: walking the names by rank finds the limit
+            # first ones sooner (about limit * len / matches names)
+            numbers = []
+            for (i, name) in enumerate(self.lowered):
+                if name.startswith(prefix):
+                    numbers.append(i)
+                    if len(numbers) == limit:
+                        break
+        else:
+            numbers = [i for (name, i) in self.alphabetical[start:end]]
+            numbers = heapq.nsmallest(limit, numbers) if limit is not None \
+                else sorted(numbers)
+        return [(self.names[i], self.counts[i]) for i in numbers]
+
+def _package_counts(session):
+    counts = dict((row.name, 0) for row in session.execute(
+            select([t_sut.c.name]).distinct()))
+    counts.update((row.sut_name, row.count) for row in session.execute(
+            select([t_facet_cube.c.sut_name,
+                    func.sum(t_facet_cube.c["count"]).label("count")])
+            .where(t_facet_cube.c.sut_name != CUBE_MISSING)
+            .group_by(t_facet_cube.c.sut_name)))
+    return counts
+
+def _maintainer_counts(session):
+    maintainers = DebianMaintainer.__table__
+    mapping = DebianPackagePeopleMapping.__table__
+    try:
+        counts = dict((row.name, 0) for row in session.execute(
+                select([maintainers.c.name]).distinct()))
+        counts.update((row.name, row.count) for row in session.execute(
+                select([maintainers.c.name,
+                        func.sum(t_facet_cube.c["count"]).label("count")])
+                .where(t_facet_cube.c.sut_name == mapping.c.package_name)
+                .where(mapping.c.maintainer_email == maintainers.c.email)
+                .group_by(maintainers.c.name)))
+    except SQLAlchemyError: # the Debian tables aren't always there
+        session.rollback()
+        return {}
+    return counts
+
+class Suggestions(object):
+    """
+    The indexes of the package and maintainer names of a db.
+    """
+    def __init__(self):
+        self.generation = None
+        self.checked_at = None # when the generation was last read
+        self.packages = None
+        self.maintainers = None
+        self.lock = threading.Lock()
+
+    def update(self, session, max_age=0):
+        """
+        Refreshes the indexes if needed, the generation being read at most
+        every max_age seconds. Returns self.
+        """
+        now = time.time()
+        if self.packages is None or now - self.checked_at >= max_age:
+            version = request_version(session)
+            self.refresh(session, version[0] if version is not None else None)
+            self.checked_at = now
+        return self
+
+    def refresh(self, session, generation):
+        """
+        Builds the indexes again if the data generation has changed (or
+        can't be read).
+        """
+        if self.packages is not None and generation is not None \
+                and generation == self.generation:
+            return
+        with self.lock:
+            if self.packages is not None and generation is not None \
+                    and generation == self.generation:
+                return
+            self.packages = TrigramIndex(_package_counts(session))
+            self.maintainers = TrigramIndex(_maintainer_counts(session))
+            self.generation = generation
+
+suggestions = Suggestions()
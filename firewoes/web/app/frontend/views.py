@@ -16,14 +16,21 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import csv
+import json
+from datetime import datetime
+from StringIO import StringIO
 
 from flask import render_template, jsonify, request, Blueprint, url_for, \
-    redirect
+    redirect, make_response, Response, stream_with_context
 from flask.views import View
 
-from firewoes.web.app import app
+from firewoes.web.app import app, cache, session, shared_context
+from firewoes.web.app.cache import request_version
+from firewoes.lib.hash import strhash
+from firewoes import __version__
 from models import Generator_app, Analysis_app, Sut_app, Result_app
-from models import Report
+from models import Report, EXPORT_COLUMNS
 from models import Http404Error, Http500Error
 
 import firewoes.lib.fedorautils as fedorautils
@@ -71,10 +78,18 @@ from pagination import Pagination
 
 def url_for_other_page(page):
     args = request.args.copy()
+    args.pop('after', None)
     args['page'] = page
     return url_for(request.endpoint, **args)
 app.jinja_env.globals['url_for_other_page'] = url_for_other_page
 
+def url_for_cursor(after):
+    args = request.args.copy()
+    args.pop('page', None)
+    args['after'] = after
+    return url_for(request.endpoint, **args)
+app.jinja_env.globals['url_for_cursor'] = url_for_cursor
+
 
 
 ### ERRORS ###
@@ -104,15 +119,34 @@ def deal_500_error(error, mode='html'):
 
 ### HTML FUNCTION ###
 
+@shared_context.register("generators_by_name")
+def generators_by_name():
+    return Generator_app().unique_by_name()
+
 def html(templatename, **kwargs):
-    generators_by_name = Generator_app().unique_by_name()
-    return render_template(templatename,
-                           generators_by_name=generators_by_name,
-                           **kwargs)
+    context = shared_context.get()
+    context.update(kwargs)
+    return render_template(templatename, **context)
 
 
 ### GENERAL VIEW HANDLING ###
 
+# the pages also change when the application is deployed again, so they're
+# never older than its start (to the second, as in the HTTP dates)
+started_at = datetime.utcnow().replace(microsecond=0)
+
+def not_modified(etag, last_modified):
+    """
+    Returns True if the conditional headers of the request tell that the
+    client already has the version (etag, last_modified) of the page.
+    If-Modified-Since is only looked at without If-None-Match.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since:
+        return last_modified <= request.if_modified_since
+    return False
+
 class GeneralView(View):
     def __init__(self, render_func=jsonify, err_func=lambda *x: x, **kwargs):
         self.render_func = render_func
@@ -120,14 +154,52 @@ class GeneralView(View):
         for kwarg in kwargs:
             setattr(self, kwarg, kwargs[kwarg])
     
-    def dispatch_request(self, **kwargs):
-        try:
+    def get_cached_objects(self, generation, **kwargs):
+        """
+        Returns get_objects(**kwargs), from the cache if possible.
+        The key is made of the view, its arguments, the (sorted) request
+        arguments and the data generation.
+        """
+        key = strhash(repr((self.__class__.__name__, generation,
+                            sorted(kwargs.items()),
+                            sorted(request.args.items(multi=True)))))
+        context = cache.get(key)
+        if context is None:
             context = self.get_objects(**kwargs)
-            return self.render_func(**context)
-        except Http500Error as e:
-            return self.err_func(e, http=500)
-        except Http404Error as e:
-            return self.err_func(e, http=404)
+            cache.set(key, context)
+        return context
+    
+    def dispatch_request(self, **kwargs):
+        version = request_version(session)
+        if version is None: # no cache, no conditional response
+            try:
+                return self.render_func(**self.get_objects(**kwargs))
+            except Http500Error as e:
+                return self.err_func(e, http=500)
+            except Http404Error as e:
+                return self.err_func(e, http=404)
+        
+        (generation, updated_at) = version
+        # the same url gives the same body, as long as the data and the
+        # application don't change
+        etag = strhash(repr((__version__, generation, request.url)))
+        last_modified = started_at
+        if updated_at is not None:
+            last_modified = max(last_modified,
+                                datetime.utcfromtimestamp(int(updated_at)))
+        if not_modified(etag, last_modified):
+            response = make_response("", 304)
+        else:
+            try:
+                context = self.get_cached_objects(generation, **kwargs)
+                response = make_response(self.render_func(**context))
+            except Http500Error as e:
+                return self.err_func(e, http=500)
+            except Http404Error as e:
+                return self.err_func(e, http=404)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return response
 
 
 ### INDEX ###
@@ -169,7 +241,10 @@ class SearchView(GeneralView):
 def render_html_search(templatename, **kwargs):
     """ adds pagination object before rendering """
     pagination = Pagination(kwargs['page'], kwargs['offset'],
-                                    kwargs['results_all_count'])
+                            kwargs['results_all_count'],
+                            max_page=app.config["SEARCH_MAX_PAGE_NUMBER"],
+                            next=kwargs['next'],
+                            total_is_capped=kwargs['results_count_is_capped'])
     return html(templatename, pagination=pagination, **kwargs)
 
 mod.add_url_rule('/search/', view_func=SearchView.as_view(
@@ -184,6 +259,50 @@ mod.add_url_rule('/api/search/', view_func=SearchView.as_view(
         err_func=lambda e, **kwargs: deal_error(e, mode='json', **kwargs)
         ))
 
+### EXPORT ###
+
+def csv_line(values):
+    line = StringIO()
+    csv.writer(line).writerow([unicode(value).encode("utf-8")
+                               if value is not None else ""
+                               for value in values])
+    return line.getvalue()
+
+# all the results of a search, streamed as NDJSON (one JSON object per
+# line, the default) or CSV (?format=csv)
+@mod.route('/api/export/')
+def export_results():
+    format_ = request.args.get("format", "ndjson")
+    results = Result_app().export(request.args)
+    if format_ == "ndjson":
+        lines = (json.dumps(result) + "\n" for result in results)
+        mimetype = "application/x-ndjson"
+    elif format_ == "csv":
+        def lines():
+            yield csv_line(EXPORT_COLUMNS)
+            for result in results:
+                yield csv_line(result[column] for column in EXPORT_COLUMNS)
+        lines = lines()
+        mimetype = "text/csv"
+    else:
+        return deal_error(Http404Error("Unknown format: %s" % format_),
+                          mode='json')
+    return Response(stream_with_context(lines), mimetype=mimetype)
+
+### COMPLETION ###
+
+# the package names beginning with ?q=, for the typeahead of the search box
+@mod.route('/api/complete/')
+def complete_json():
+    prefix = request.args.get("q", "")
+    limit = request.args.get("limit", app.config["COMPLETE_MAX_NUMBER"],
+                             type=int)
+    limit = max(0, min(limit, app.config["COMPLETE_MAX_NUMBER"]))
+    if not prefix:
+        return jsonify(dict(query=prefix, completions=[]))
+    return jsonify(dict(query=prefix,
+                        completions=Sut_app().complete(prefix, limit)))
+
 ### REPORT ###
 
 # redirects the searches
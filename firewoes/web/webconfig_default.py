@@ -40,6 +40,49 @@ SEARCH_MENU_MAX_NUMBER_OF_CHARS = 28
 # The number of results to display (per default) on a search results page
 SEARCH_RESULTS_OFFSET = 10
 
+# The last page of search results which is linked by its number, the next
+# ones are reached page after page, with cheaper "after" tokens
+SEARCH_MAX_PAGE_NUMBER = 50
+
+# When a search gives no results, at most this number of package or
+# maintainer names are suggested
+SEARCH_SUGGESTIONS_MAX_NUMBER = 20
+
+# The exports of search results (/api/export/) fetch the results by
+# batches of this size
+EXPORT_BATCH_SIZE = 1000
+
+# The completions of package names (/api/complete/?q=...): their maximum
+# number, and how often (in seconds) the data generation is checked to know
+# whether the names must be loaded again
+COMPLETE_MAX_NUMBER = 10
+COMPLETE_MAX_AGE = 10
+
+# The search results are counted up to this number ("10000+ results"),
+# unless an exact count is asked for (?exact_count=1)
+SEARCH_COUNT_MAX = 10000
+
+# The cache of the search, report and result views: "lru" (in each process),
+# "filesystem", "memcached", "redis", or "null" (no cache)
+CACHE_TYPE = "lru"
+
+# the maximum number of entries (for lru and filesystem)
+CACHE_THRESHOLD = 500
+
+# the lifetime of an entry, in seconds (0: forever). Entries are outdated
+# anyway as soon as new data is inserted by firewoes_fill_db
+CACHE_DEFAULT_TIMEOUT = 3600
+
+CACHE_DIR = "/tmp/firewoes-cache"
+CACHE_MEMCACHED_SERVERS = ["127.0.0.1:11211"]
+CACHE_REDIS_HOST = "localhost"
+CACHE_REDIS_PORT = 6379
+
+# the lifetime, in seconds, of the variables shared by all the pages (e.g.
+# the generators of the menu), kept in each process. They're computed again
+# sooner if new data is inserted
+SHARED_CONTEXT_TIMEOUT = 300
+
 # the url pattern used to generate urls to point on source code
 DEBIAN_SOURCES_URL = "http://sources.debian.net/src/{package}/{version}-{release}/{path}?msg={message}&hl={lines_range}#L{anchor}"
 
@@ -2,13 +2,31 @@ import os
 import sys
 import unittest
 import json
+import shutil
+import tempfile
+import gzip
+import tarfile
 from glob import glob
+from datetime import timedelta
+
+from sqlalchemy import create_engine, select, func
+from sqlalchemy.orm import subqueryload
 
 testsdir = os.path.dirname(os.path.abspath(__file__))
 
 from firewoes.lib import orm
+from firewoes.lib.hash import idify, strhash
+from firewoes.lib.cache import LRUCache
+from firewoes.lib.sources import iter_sources
+from firewoes.lib.dbutils import get_engine_session
+from firewoes.lib.serialize import serialize
+from firewoes.lib.manifest import Manifest
+from firewoes.lib import search
 from firewoes.bin import firewoes_fill_db
-from firewoes.web.app import app
+from firewoes.web.app import app, cache
+from firewoes.web.app.frontend import views
+from firewoes.web.app.frontend.pagination import Pagination
+from firewoes.web.app.frontend.suggestions import TrigramIndex
 
 class FirewoesTestCase(unittest.TestCase):
     ClassIsSetup = False
@@ -49,9 +67,11 @@ class FirewoesTestCase(unittest.TestCase):
         rv = json.loads(self.app.get('/api/search/?sut_name=pyth').data)
         assert rv['suggestions'][0]["sut_name"] == "python-ethtool"
         
-    def test_maintainers_suggestions(self):
-        # TODO
-        assert True
+    def test_packages_completions(self):
+        rv = json.loads(self.app.get('/api/complete/?q=Python-').data)
+        assert rv['completions'] == [dict(name="python-ethtool", count=18)]
+        rv = json.loads(self.app.get('/api/complete/?q=ethtool').data)
+        assert rv['completions'] == []
         
     def test_home_links(self):
         rv = self.app.get('/')
@@ -69,23 +89,24 @@ class FirewoesTestCase(unittest.TestCase):
         assert rv['results_all_count'] == 18
         
     def test_search_list_root(self):
+        # the results are ordered by id
         rv = json.loads(self.app.get('/api/search/').data)
         assert rv["results"][0] == {
             "sut_buildarch": "x86_64", 
-            "location_function": "set_ringparam", 
+            "location_function": "get_tso", 
             "Point": {
-                "column": 1, 
-                "line": 881, 
-                "id": "b9a229d8cb6e8d80bbe64739c6d8e5287efc0ec6"
+                "column": 22, 
+                "line": 658, 
+                "id": "7b2c99d8f5526ae4d55a66f1bca53233eed1437f"
                 }, 
-            "message_text": "returning (PyObject*)NULL without setting an "
-                                                    "exception", 
+            "message_text": "Mismatching type in call to Py_BuildValue with "
+                                                    "format code \"b\"", 
             "location_file": "python-ethtool/ethtool.c", 
             "Range": None, 
-            "id": "e137be9fe3e6f9ab042f4cfd1e8074446b556fa7", 
-            "message_id": "eea211bacf3c996e3e8c0d3364384da5b299ba14", 
+            "id": "06f72ba987cb6cd69796055f0fb4f8b8c707e275", 
+            "message_id": "4871c2ade5bedaa5d07d0566fd2e2445185c6d90", 
             "sut_name": "python-ethtool", 
-            "testid": "returns-NULL-without-setting-exception", 
+            "testid": "mismatching-type-in-format-string", 
             "generator_name": "cpychecker", 
             "sut_release": "0.dc309d6b2781dc3810021d2e4e2d669f40227b63.fc17"
                                                    ".src.rpm", 
@@ -94,7 +115,70 @@ class FirewoesTestCase(unittest.TestCase):
             "sut_version": "0.8", 
             "generator_version": None
             }
+    
+    def test_search_list_after(self):
+        ids = []
+        url = '/api/search/?offset=4'
+        while url:
+            rv = json.loads(self.app.get(url).data)
+            ids += [res["id"] for res in rv["results"]]
+            url = rv["next"] and '/api/search/?offset=4&after=' + rv["next"]
+        assert len(ids) == 18
+        assert ids == sorted(set(ids))
+        
+    def test_search_list_after_invalid(self):
+        for after in ["%25%25%25%25", "Zm9v", "\xc3\xa9"]:
+            rv = json.loads(self.app.get('/api/search/?after=' + after).data)
+            assert rv == dict(error=404)
+        
+    def test_search_list_not_modified(self):
+        rv = self.app.get('/api/search/?sut_name=python-ethtool')
+        etag = rv.headers["ETag"]
+        assert self.app.get('/api/search/?sut_name=python-ethtool',
+                            headers={"If-None-Match": etag}).status_code == 304
+        assert self.app.get('/api/search/?sut_name=pyth',
+                            headers={"If-None-Match": etag}).status_code == 200
         
+    def test_search_list_modified_since(self):
+        url = '/api/search/?sut_name=python-ethtool'
+        last_modified = self.app.get(url).headers["Last-Modified"]
+        headers = {"If-Modified-Since": last_modified}
+        assert self.app.get(url, headers=headers).status_code == 304
+        # a new deployment, with the same data
+        started_at = views.started_at
+        views.started_at += timedelta(days=1)
+        try:
+            assert self.app.get(url, headers=headers).status_code == 200
+        finally:
+            views.started_at = started_at
+        
+    def test_search_count_capped(self):
+        count_max = self.config["SEARCH_COUNT_MAX"]
+        self.config["SEARCH_COUNT_MAX"] = 5
+        cache.clear() # the pages counted with the default maximum
+        try:
+            rv = json.loads(self.app.get('/api/search/?offset=4').data)
+            assert rv["results_all_count"] == 5
+            assert rv["results_count_is_capped"]
+            rv = json.loads(self.app.get('/api/search/?offset=4'
+                                         '&exact_count=1').data)
+            assert rv["results_all_count"] == 18
+            assert not rv["results_count_is_capped"]
+            rv = self.app.get('/search/?offset=4')
+            assert "displaying 1-4 of\n  5+ results" in rv.data
+        finally:
+            self.config["SEARCH_COUNT_MAX"] = count_max
+            cache.clear()
+        rv = json.loads(self.app.get('/api/search/?offset=4').data)
+        assert rv["results_all_count"] == 18
+        assert not rv["results_count_is_capped"]
+    
+    def test_pagination_total(self):
+        pagination = Pagination(1, 10, 5000, total_is_capped=True)
+        assert pagination.total == "5000+"
+        assert pagination.pages == 500
+        assert Pagination(1, 10, 18).total == "18"
+    
     def test_search_list_testid(self):
         rv = json.loads(self.app.get('/api/search/?generator_name=cpychecker'
                                      '&testid=null-ptr-argument').data)
@@ -109,6 +193,28 @@ class FirewoesTestCase(unittest.TestCase):
                                      '&location_function=get_ufo').data)
         assert rv["results"][0]["location_function"] == "get_ufo"
         
+    def test_search_list_message(self):
+        rv = json.loads(self.app.get('/api/search/?message=BuildValue%20b'
+                                     '&offset=100').data)
+        assert len(rv["results"]) > 0
+        for res in rv["results"]:
+            assert "Py_BuildValue" in res["message_text"]
+            assert '"b"' in res["message_text"]
+        rv = json.loads(self.app.get('/api/search/?message=nosuchword'
+                                     ).data)
+        assert rv["results"] == []
+        
+    def test_export(self):
+        rv = self.app.get('/api/export/?sut_name=python-ethtool')
+        results = [json.loads(line) for line in rv.data.splitlines()]
+        assert len(results) == 18
+        assert [res["id"] for res in results] == sorted(res["id"]
+                                                        for res in results)
+        rv = self.app.get('/api/export/?sut_name=python-ethtool&format=csv')
+        lines = rv.data.splitlines()
+        assert lines[0].startswith("id,result_type,testid,message_text,")
+        assert len(lines) == 19
+        
     def test_drilldownmenu_root(self):
         rv = json.loads(self.app.get('/api/search/').data)
         assert rv["menu"][1] == {
@@ -134,7 +240,18 @@ class FirewoesTestCase(unittest.TestCase):
                                      '&location_file=python-ethtool%2Fethtool.c'
                                      ).data)
         assert rv["menu"][2]["active"] == True
-        assert rv["menu"][10]["items"][0]["value"] == "get_ufo"
+        # 5 functions have 2 results, the ties are ordered by name
+        assert rv["menu"][10]["items"][0] == {
+            "count": 2,
+            "link": {
+                "generator_name": "cpychecker",
+                "sut_name": "python-ethtool",
+                "sut_version": "0.8",
+                "location_file": "python-ethtool/ethtool.c",
+                "location_function": "get_devices"
+                },
+            "value": "get_devices"
+            }
         
     def test_reports(self):
         rv = json.loads(self.app.get('/api/report/python-ethtool/').data)
@@ -145,5 +262,428 @@ class FirewoesTestCase(unittest.TestCase):
             ]
         assert rv["results"][0]["package"]["name"] == "python-ethtool"
 
+class SuggestionsTestCase(unittest.TestCase):
+    counts = {"python-ethtool": 18, "python-apt": 3, "pyflakes": 3,
+              "ethtool": 0}
+    
+    def test_complete(self):
+        index = TrigramIndex(self.counts)
+        assert index.complete("PY") == [("python-ethtool", 18),
+                                        ("pyflakes", 3), ("python-apt", 3)]
+        assert index.complete("py", limit=1) == [("python-ethtool", 18)]
+        assert index.complete("py", limit=0) == []
+        assert index.complete("py", limit=-1) == []
+    
+    def test_search_limit(self):
+        index = TrigramIndex(self.counts)
+        assert index.search("t", limit=0) == []
+        assert index.search("t", limit=-1) == []
+        assert len(index.search("t")) == 3
+    
+    def test_search_maintainers(self):
+        # maintainer name -> number of results of their packages
+        index = TrigramIndex({"Foo Bar": 18, "Leo Baz": 2, "Ugo Bo": 0,
+                              None: 5})
+        assert index.search("o b") == ["Foo Bar", "Leo Baz", "Ugo Bo"]
+        assert index.search("O B", min_count=1) == ["Foo Bar", "Leo Baz"]
+        assert index.search("ba", limit=1) == ["Foo Bar"]
+        assert index.search("zz") == []
+
+class IdifyTestCase(unittest.TestCase):
+    # analysis ids of tests/data, as computed by the first (recursive)
+    # implementation of idify: as the id of a node is the hash of its
+    # children ids, this checks the ids of every node
+    analysis_ids = {
+        "0bb1de0f8aab43df2f613082aa8d1fc18d8c01b1.xml":
+            "00f62063e0805a14190c10dbacf66e9a489f236d",
+        "0eda945826402f9d93ebb10f8542fa37ed134ff4.xml":
+            "e14570f4daa05ec28a97893e2bb5b5290bb7828e",
+        "1eae3b5cbd1f52e278866ded6650640b576911c9.xml":
+            "7b9536bdc216f094ca7ca37090bbe32d5280c94b",
+        "2e32c857885f9e34f98a48ee5d31f1ee09adc226.xml":
+            "d1cd655ff5d68df54e98d858c5e6c096587badad",
+        "4a3fbb229ef6612fee5fac7a6b7416b0ecbf7351.xml":
+            "54918a2d664b2bf993b5d031290c88045eb848fa",
+        "5c9e38724b70fea0d30c106ec01ce19f73a7f342.xml":
+            "358cc920b9a18e1601e9750b5cf4920725420c7d",
+        }
+    
+    def test_idify_regression(self):
+        for (filename, analysis_id) in self.analysis_ids.items():
+            analysis = orm.Analysis.from_xml(testsdir + "/data/" + filename)
+            (analysis, analysishash) = idify(analysis)
+            assert analysishash == analysis_id
+            assert analysis.id == analysis_id
+    
+    def test_idify_scalars(self):
+        assert idify(None) == (None, strhash(""))
+        assert idify(42) == (42, strhash("42"))
+        assert idify([1, "a"]) == [(1, strhash("1")), ("a", strhash("a"))]
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_eviction_order(self):
+        cache = LRUCache(3)
+        for key in "abc":
+            cache[key] = key.upper()
+        assert cache["a"] == "A" # a is now the most recently used
+        cache["d"] = "D"
+        assert list(cache) == ["c", "a", "d"] # b was evicted
+        cache["c"] = "C2" # replacing a value uses it too
+        cache["e"] = "E"
+        assert list(cache) == ["d", "c", "e"]
+        assert cache.get("a") is None
+        assert len(cache) == 3
+
+def recursive_to_dict(elem):
+    """
+    The former serialization of the web application, without the cycle
+    protection, to check firewoes.lib.serialize against.
+    """
+    if elem is None:
+        return None
+    elif type(elem) in [int, float, str, unicode, bool, long]:
+        return elem
+    elif isinstance(elem, list):
+        return [recursive_to_dict(e) for e in elem]
+    res = dict()
+    for attr_name in type(elem)._sa_class_manager.local_attrs:
+        res[attr_name] = recursive_to_dict(getattr(elem, attr_name))
+    return res
+
+class SerializeTestCase(unittest.TestCase):
+    def setUp(self):
+        (self.engine, self.session) = get_engine_session(
+            app.config["DATABASE_URI"])
+    
+    def tearDown(self):
+        self.session.remove()
+    
+    def test_results(self):
+        results = self.session.query(orm.Result).all()
+        assert len(results) == 18
+        for result in results:
+            assert serialize(result) == recursive_to_dict(result)
+        assert serialize(None) is None
+    
+    def test_shared_nodes(self):
+        # the file of all the states of a trace is serialized once
+        traces = [result.trace for result in
+                  self.session.query(orm.Result).all()
+                  if getattr(result, "trace", None) is not None]
+        trace = max(traces, key=lambda trace: len(trace.states))
+        assert len(set(state.location.file for state in trace.states)) == 1
+        states = serialize(trace)["states"]
+        assert len(states) > 1
+        assert all(state["location"]["file"] is states[0]["location"]["file"]
+                   for state in states)
+        assert states == recursive_to_dict(trace)["states"]
+    
+    def test_cycle(self):
+        # analysis -> results -> analysis: the second time, the analysis
+        # is serialized without its relationships
+        analysis = (self.session.query(orm.Analysis)
+                    .options(subqueryload("results"))
+                    .filter(orm.Analysis.results.any()).one())
+        res = serialize(analysis)
+        assert len(res["results"]) == 18
+        for result in res["results"]:
+            assert result["analysis"] == dict(
+                id=analysis.id, metadata_id=analysis.metadata_id,
+                customfields_id=analysis.customfields_id)
+            assert result["location"]["file"]["givenpath"]
+
+class IngestionTestCase(unittest.TestCase):
+    xml_files = sorted(glob(testsdir + "/data/*.xml"))
+    
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def fill(self, name, xml_files=None, **kwargs):
+        """
+        Fills the db name of the temporary directory, returns its engine.
+        """
+        url = "sqlite:///" + os.path.join(self.tmpdir, name)
+        stdout = sys.stdout # the progress isn't printed
+        sys.stdout = open(os.devnull, "w")
+        try:
+            firewoes_fill_db.read_and_create(url, xml_files or self.xml_files,
+                                             **kwargs)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        return create_engine(url)
+    
+    def dump(self, engine):
+        """
+        Returns the sorted rows of each table of the Firehose objects.
+        """
+        return dict((table.name, sorted(tuple(row) for row in
+                                        engine.execute(table.select())))
+                    for table in orm.metadata.sorted_tables)
+    
+    def make_sources(self):
+        """
+        Spreads the reports of tests/data into an archive, a compressed
+        report and a directory. Returns their paths.
+        """
+        def gzip_copy(src, dst):
+            with open(src, "rb") as f:
+                compressed = gzip.open(dst, "wb")
+                compressed.write(f.read())
+                compressed.close()
+        
+        (first, second, third, fourth, fifth, sixth) = self.xml_files
+        archive = os.path.join(self.tmpdir, "reports.tar.gz")
+        tar = tarfile.open(archive, "w:gz")
+        tar.add(first, "a/first.xml")
+        gzipped = os.path.join(self.tmpdir, "second.xml.gz")
+        gzip_copy(second, gzipped)
+        tar.add(gzipped, "b/second.xml.gz")
+        tar.add(testsdir + "/tests.py", "b/tests.py") # not a report
+        tar.close()
+        report = os.path.join(self.tmpdir, "third.xml.gz")
+        gzip_copy(third, report)
+        directory = os.path.join(self.tmpdir, "dir")
+        os.makedirs(os.path.join(directory, "sub"))
+        shutil.copy(fourth, os.path.join(directory, "fourth.xml"))
+        shutil.copy(fifth, os.path.join(directory, "sub", "fifth.xml"))
+        shutil.copy(sixth, os.path.join(directory, "sub", "sixth.xml"))
+        shutil.copy(testsdir + "/tests.py", directory) # not a report
+        return [archive, report, directory]
+    
+    def make_versions(self, versions):
+        """
+        Returns the paths of copies of the report with issues, as the
+        analyses of the given versions of its package: they share their
+        results.
+        """
+        with open(testsdir + "/data/4a3fbb229ef6612fee5fac7a6b7416b0ecbf7351"
+                  ".xml") as f:
+            report = f.read()
+        paths = []
+        for version in versions:
+            path = os.path.join(self.tmpdir, "ethtool-%s.xml" % version)
+            with open(path, "w") as f:
+                f.write(report.replace('version="0.8"',
+                                       'version="%s"' % version))
+            paths.append(path)
+        return paths
+    
+    def test_shared_results(self):
+        # a shared result belongs to the last analysis
+        (first, second) = self.make_versions(["0.8", "0.9"])
+        for loader in ["orm", "core"]:
+            for batch_size in [1, 2]:
+                engine = self.fill("%s-%d.db" % (loader, batch_size),
+                                   [first, second], drop=True,
+                                   loader=loader, batch_size=batch_size)
+                assert [tuple(row) for row in engine.execute(
+                        select([orm.t_sut.c.version,
+                                func.count(orm.t_result.c.id)])
+                        .select_from(orm.t_result.join(orm.t_analysis)
+                                     .join(orm.t_metadata)
+                                     .join(orm.t_sut))
+                        .group_by(orm.t_sut.c.version))] == [("0.9", 18)]
+                if loader == "orm" and batch_size == 1:
+                    expected = self.dump(engine)
+                else:
+                    assert self.dump(engine) == expected
+                # the search rows are moved with their results
+                assert sorted(tuple(row) for row in engine.execute(
+                        select([search.t_result_search.c.result_id,
+                                search.t_result_search.c.analysis_id]))) == \
+                    sorted(tuple(row) for row in engine.execute(
+                        select([orm.t_result.c.id,
+                                orm.t_result.c.analysis_id])))
+                self.check_search_tables(engine)
+    
+    def check_search_tables(self, engine):
+        """
+        Checks that the search table and the facet cube, updated at each
+        commit, are the ones rebuilt from the Firehose tables.
+        """
+        tables = [search.t_result_search, search.t_facet_cube]
+        updated = [sorted(tuple(row) for row in engine.execute(table.select()))
+                   for table in tables]
+        with engine.begin() as connection:
+            search.rebuild(connection)
+        assert [sorted(tuple(row) for row in engine.execute(table.select()))
+                for table in tables] == updated
+    
+    def test_rebuild_search(self):
+        # the search tables are recreated, with their current indexes
+        engine = self.fill("rebuild.db", drop=True)
+        matching = (select([func.count()])
+                    .select_from(search.t_result_search)
+                    .where(search.text_match(["mismatching", "Py_BuildValue"])))
+        count = engine.execute(matching).scalar()
+        assert count > 0
+        engine.execute("DROP INDEX ix_facet_cube_dimensions")
+        engine.execute("DROP TRIGGER result_search_fts_insert")
+        engine.execute("DELETE FROM result_search_fts")
+        with engine.begin() as connection:
+            search.rebuild(connection)
+        assert engine.execute("SELECT count(*) FROM sqlite_master WHERE name "
+                              "IN ('ix_facet_cube_dimensions', "
+                              "'result_search_fts_insert')").scalar() == 2
+        assert engine.execute(matching).scalar() == count
+    
+    def test_facet_cube(self):
+        # the cube updated at each commit is the same as the one rebuilt
+        # from the search table, with and without upserts
+        moved = os.path.join(self.tmpdir, "moved.xml")
+        with open(testsdir + "/data/4a3fbb229ef6612fee5fac7a6b7416b0ecbf7351"
+                  ".xml") as f:
+            # other results (on other lines), in the same combinations
+            report = f.read().replace('line="', 'line="1')
+        with open(moved, "w") as f:
+            f.write(report)
+        has_upsert = search.has_upsert
+        for upsert in [True, False]:
+            search.has_upsert = lambda dialect: upsert and has_upsert(dialect)
+            try:
+                engine = self.fill("cube.db", self.xml_files + [moved],
+                                   drop=True)
+            finally:
+                search.has_upsert = has_upsert
+            cube = sorted(tuple(row) for row in
+                          engine.execute(search.t_facet_cube.select()))
+            assert len(cube) == 5
+            assert sum(row[-1] for row in cube) == 36
+            with engine.begin() as connection:
+                search.rebuild(connection)
+            assert sorted(tuple(row) for row in engine.execute(
+                    search.t_facet_cube.select())) == cube
+    
+    def test_iter_sources(self):
+        (archive, report, directory) = self.make_sources()
+        sources = list(iter_sources([archive, report, directory]))
+        assert [str(source) for source in sources] == [
+            archive + ":a/first.xml",
+            archive + ":b/second.xml.gz",
+            report,
+            os.path.join(directory, "fourth.xml"),
+            os.path.join(directory, "sub", "fifth.xml"),
+            os.path.join(directory, "sub", "sixth.xml"),
+            ]
+        for (source, xml_file) in zip(sources, self.xml_files):
+            with open(xml_file, "rb") as f:
+                assert source.open().read() == f.read()
+    
+    def test_iter_sources_errors(self):
+        # the archives which can't be read are skipped
+        truncated = os.path.join(self.tmpdir, "truncated.tar.gz")
+        with open(truncated, "wb") as f:
+            f.write("\x1f\x8b")
+        missing = os.path.join(self.tmpdir, "missing.tar.gz")
+        stdout = sys.stdout # the errors are printed
+        sys.stdout = open(os.devnull, "w")
+        try:
+            sources = list(iter_sources([missing, truncated,
+                                         self.xml_files[0]]))
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        assert [str(source) for source in sources] == [self.xml_files[0]]
+    
+    def test_fill_from_sources(self):
+        expected = self.dump(self.fill("files.db", drop=True))
+        assert self.dump(self.fill("sources.db", self.make_sources(),
+                                   drop=True)) == expected
+    
+    def test_manifest(self):
+        engine = self.fill("manifest.db", drop=True, manifest=True)
+        expected = self.dump(engine)
+        # a second run skips every file, even under another name
+        copy = os.path.join(self.tmpdir, "copy.xml")
+        shutil.copy(self.xml_files[0], copy)
+        manifest = Manifest(engine)
+        assert list(manifest.filter_new(
+                iter_sources(self.xml_files + [copy]))) == []
+        assert manifest.skipped == 7
+        # the unreadable files are yielded, to be reported when read
+        missing = os.path.join(self.tmpdir, "missing.xml")
+        os.symlink(os.path.join(self.tmpdir, "nowhere.xml"), missing)
+        assert [str(source) for source in manifest.filter_new(
+                iter_sources([missing]))] == [missing]
+        
+        # and nothing is parsed
+        parsed = []
+        parse_analysis = firewoes_fill_db.parse_analysis
+        def counting_parse_analysis(xml_file):
+            parsed.append(xml_file)
+            return parse_analysis(xml_file)
+        firewoes_fill_db.parse_analysis = counting_parse_analysis
+        try:
+            engine = self.fill("manifest.db", self.xml_files + [missing],
+                               manifest=True)
+        finally:
+            firewoes_fill_db.parse_analysis = parse_analysis
+        assert parsed == []
+        assert self.dump(engine) == expected
+    
+    def test_orm_loader_small_cache(self):
+        # with a cache of one object, the nodes are looked up in the db
+        expected = self.dump(self.fill("orm.db", drop=True))
+        assert len(expected["analysis"]) == 6
+        assert len(expected["result"]) == 18
+        assert self.dump(self.fill("orm_cache.db", drop=True, cache_size=1,
+                                   batch_size=4)) == expected
+    
+    def test_core_loader(self):
+        expected = self.dump(self.fill("orm.db", drop=True))
+        assert self.dump(self.fill("core.db", drop=True,
+                                   loader="core")) == expected
+        assert self.dump(self.fill("core_batch.db", drop=True, loader="core",
+                                   batch_size=4)) == expected
+    
+    def test_parallel_parsing(self):
+        # the analyses parsed by several processes are inserted in the same
+        # order, so the db is the same
+        expected = self.dump(self.fill("serial.db", drop=True, jobs=1))
+        assert self.dump(self.fill("parallel.db", drop=True,
+                                   jobs=2)) == expected
+    
+    def test_failing_analysis(self):
+        # an analysis failing once some of its rows are written is rolled
+        # back to its savepoint, and the rest of its batch is committed
+        failing = self.xml_files[4] # the one with results
+        failing_id = firewoes_fill_db.parse_analysis(failing).id
+        expected = self.dump(self.fill("expected.db", [
+                    xml_file for xml_file in self.xml_files
+                    if xml_file != failing], drop=True))
+        assert len(expected["analysis"]) == 5
+        
+        uniquify = firewoes_fill_db.uniquify
+        def failing_uniquify(session, analysis):
+            analysis = uniquify(session, analysis)
+            if analysis.id == failing_id:
+                session.merge(analysis)
+                session.flush()
+                raise Exception("failing analysis")
+            return analysis
+        
+        bulk_insert = firewoes_fill_db.bulk_insert
+        def failing_bulk_insert(connection, analysis):
+            bulk_insert(connection, analysis)
+            if analysis.id == failing_id:
+                raise Exception("failing analysis")
+        
+        for (loader, name, function) in [
+            ("orm", "uniquify", failing_uniquify),
+            ("core", "bulk_insert", failing_bulk_insert)]:
+            original = getattr(firewoes_fill_db, name)
+            setattr(firewoes_fill_db, name, function)
+            try:
+                engine = self.fill(loader + ".db", drop=True, loader=loader,
+                                   batch_size=3)
+            finally:
+                setattr(firewoes_fill_db, name, original)
+            assert self.dump(engine) == expected
+            self.check_search_tables(engine)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,112 @@
+# Copyright (C) 2013  Matthieu Caneill <matthieu.caneill@gmail.com>
+#
+# This file is part of Firewoes.
+#
+# Firewoes is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# compares the serialization of a result with a large trace by
+# firewoes.lib.serialize and by a generic recursive walk of the attributes
+# run from the root of the source tree:
+# PYTHONPATH=. python tools/benchmark_serialize.py [--states N] [--runs N]
+
+import argparse
+import time
+
+from firewoes.lib.dbutils import get_engine_session
+from firewoes.lib.orm import metadata, Issue, t_generator, t_metadata, \
+    t_analysis, t_result, t_trace, t_state, t_location, t_file, t_function, \
+    t_point, t_notes, t_message
+from firewoes.lib.serialize import serialize
+
+def recursive_to_dict(elem):
+    """
+    The generic serialization: each object's attributes are looked up in
+    its class manager, and serialized according to their type.
+    """
+    if elem is None:
+        return None
+    elif type(elem) in [int, float, str, unicode, bool, long]:
+        return elem
+    elif isinstance(elem, list):
+        return [recursive_to_dict(e) for e in elem]
+    res = dict()
+    for attr_name in type(elem)._sa_class_manager.local_attrs:
+        res[attr_name] = recursive_to_dict(getattr(elem, attr_name))
+    return res
+
+def fill(engine, states):
+    """
+    Inserts an issue whose trace has the given number of states.
+    """
+    with engine.begin() as connection:
+        connection.execute(t_generator.insert(), id="g", name="benchmark")
+        connection.execute(t_metadata.insert(), id="m", generator_id="g")
+        connection.execute(t_analysis.insert(), id="a", metadata_id="m")
+        connection.execute(t_file.insert(), id="f", givenpath="foo.c")
+        connection.execute(t_function.insert(), id="fn", name="foo")
+        connection.execute(t_message.insert(), id="msg", text="message")
+        connection.execute(t_trace.insert(), id="t")
+        connection.execute(t_point.insert(), [
+                dict(id="p%d" % i, line=i, column=i % 80)
+                for i in range(states)])
+        connection.execute(t_location.insert(), [
+                dict(id="l%d" % i, file_id="f", function_id="fn",
+                     point_id="p%d" % i)
+                for i in range(states)])
+        connection.execute(t_notes.insert(), [
+                dict(id="n%d" % i, text="state %d" % i)
+                for i in range(states)])
+        connection.execute(t_state.insert(), [
+                dict(id="s%08d" % i, trace_id="t", location_id="l%d" % i,
+                     notes_id="n%d" % i)
+                for i in range(states)])
+        connection.execute(t_result.insert(), id="r", type="issue",
+                           analysis_id="a", message_id="msg",
+                           location_id="l0", trace_id="t")
+
+def best_time(func, elem, runs):
+    times = []
+    for i in range(runs):
+        start = time.time()
+        res = func(elem)
+        times.append(time.time() - start)
+    return (min(times), res)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the\
+    serialization of a result with a large trace.")
+    parser.add_argument("--states", type=int, default=10000,
+                        help="number of states of the trace")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="number of runs of each serializer")
+    args = parser.parse_args()
+
+    engine, session = get_engine_session("sqlite://")
+    metadata.create_all(engine)
+    fill(engine, args.states)
+
+    # the result and its trace are loaded once, the lazy relationships
+    # (e.g. the analysis) by the first run
+    issue = session.query(Issue).filter(Issue.id == "r").one()
+    serialize(issue)
+
+    (recursive, expected) = best_time(recursive_to_dict, issue, args.runs)
+    (compiled, res) = best_time(serialize, issue, args.runs)
+    assert res == expected
+
+    print("%d states, best of %d runs" % (args.states, args.runs))
+    print("recursive to_dict: %.3fs" % recursive)
+    print("serialize:         %.3fs" % compiled)
+    print("speedup:           %.1fx" % (recursive / compiled))